@@ -7,16 +7,20 @@
 #               KTH Stockholm Royal Institute of Technology
 #               IGLU - CHIST-ERA
 
-import argparse, os, sys, random
+import argparse, os, sys, random, time
 from shutil import rmtree as rm_dir
 from itertools import groupby
 from collections import defaultdict
+from multiprocessing import Pool, TimeoutError
 
 import json
 import numpy as np
 
 from utils.misc import init_random_seed, generate_info_section, save_arguments
 from utils.elementary_sounds import Elementary_Sounds
+from utils.scene_dedup_index import Scene_Dedup_Index
+from utils.scene_io import scene_file_formats, create_scene_writer, get_scene_filepath, \
+    get_elementary_sounds_filename, get_generation_state_filepath, get_scene_file_format, load_scene_file
 
 # Arguments definition
 parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
@@ -26,6 +30,9 @@ parser.add_argument('--elementary_sounds_folder', default='./elementary_sounds',
                     help='Folder containing all the elementary sounds and the JSON listing them')
 parser.add_argument('--elementary_sounds_definition_filename', default='elementary_sounds.json',
                     help='Filename of the JSON file listing the attributes of the elementary sounds')
+parser.add_argument('--no_analysis_cache', action='store_true',
+                    help='If set, the elementary sounds are analysed (loudness, brightness, duration) without using '
+                         'the analysis cache stored in the elementary sounds folder')
 
 parser.add_argument('--metadata_file', default='templates/attributes.json',
                     help='File containing all the information related to the possible attributes of the objects')
@@ -41,6 +48,17 @@ parser.add_argument('--nb_scene', default=None, type=int,
 parser.add_argument('--silence_padding_per_object', default=100, type=int,
                     help='Silence length that will be introduced between the objects (in ms)')
 
+parser.add_argument('--sampling_method', default='rejection', type=str,
+                    choices=['rejection', 'batched', 'constructive'],
+                    help='Method used to sample the scenes. "rejection" draw and validate one candidate at a time. '
+                         '"batched" draw {sampling_batch_size} candidates at once and validate them with numpy. '
+                         '"constructive" build {sampling_batch_size} candidates at once that satisfy the families '
+                         'and attributes constraints by construction. The scene lengths follow the same distribution '
+                         'as the accepted scenes of the rejection sampler')
+parser.add_argument('--sampling_batch_size', default=4096, type=int,
+                    help='Number of candidate scenes drawn at once when using the "batched" or "constructive" '
+                         'sampling methods')
+
 # Constraints
 parser.add_argument('--constraint_min_nb_families', default=3, type=int,
                     help='Minimum number of instrument families required for the scene to be valid')
@@ -63,10 +81,36 @@ parser.add_argument('--output_version_nb', default='0.1', type=str,
                     help='Version number that will be appended to the generated scene file')
 parser.add_argument('--clear_existing_files', action='store_true',
                     help='If set, will delete all files in the output folder before starting the generation.')
+parser.add_argument('--append', action='store_true',
+                    help='If set, {nb_scene} new scenes are added to the existing sets of {output_version_nb}. '
+                         'The random streams are continued from the saved generation state, the existing scenes are '
+                         'not generated again and the scene indexes continue from the existing ones')
+parser.add_argument('--output_format', default='json', type=str, choices=scene_file_formats,
+                    help='Layout of the scene files. "json" keep all the scenes in memory and write one JSON file per '
+                         'set. "jsonl" and "chunked_json" write the scenes as they are generated in a JSON Lines file '
+                         'or in JSON files of {scenes_per_chunk} scenes')
+parser.add_argument('--scenes_per_chunk', default=1000, type=int,
+                    help='Number of scenes in each file when using the "chunked_json" output format')
+parser.add_argument('--no_relationships', action='store_true',
+                    help='If set, the before/after relationships are not written in the scene files. '
+                         'They are implied by the position of the objects and derived by the question engine')
+parser.add_argument('--compact_scene_format', action='store_true',
+                    help='If set, scene objects only contain the id of their elementary sound and their silence '
+                         'duration. The elementary sounds attributes are written once in '
+                         '{output_filename_prefix}_elementary_sounds.json')
 
 # Misc
 parser.add_argument('--random_nb_generator_seed', default=None, type=int,
                     help='Set the random number generator seed to reproduce results')
+parser.add_argument('--nb_process', default=None, type=int,
+                    help='If set, the generation is splitted in shards of {scenes_per_shard} scenes distributed across '
+                         '{nb_process} processes. Each shard use its own random stream derived from the seed so the '
+                         'generated scenes are the same for any number of process. The elementary sounds missing '
+                         'from the analysis cache are also analysed in {nb_process} processes')
+parser.add_argument('--scenes_per_shard', default=2000, type=int,
+                    help='Number of scenes generated by each shard when --nb_process is set')
+parser.add_argument('--progress_every', default=30, type=int,
+                    help='Print the generation progress every X seconds')
 
 
 class Scene_generator:
@@ -89,14 +133,46 @@ class Scene_generator:
                  constraint_min_nb_families,
                  constraint_min_objects_per_family,
                  constraint_min_nb_families_subject_to_min_object_per_family,
-                 constraint_min_ratio_for_attribute):
+                 constraint_min_ratio_for_attribute,
+                 sampling_method='rejection',
+                 sampling_batch_size=4096,
+                 compact_scene_format=False,
+                 elementary_sounds_filename=None,
+                 store_relationships=True,
+                 progress_every=30,
+                 use_analysis_cache=True,
+                 analysis_nb_process=None):
 
         self.version_nb = version_nb
 
+        self.sampling_method = sampling_method
+        self.sampling_batch_size = sampling_batch_size
+
+        # Compact scenes reference the elementary sounds definition written in {elementary_sounds_filename}
+        self.compact_scene_format = compact_scene_format
+        self.elementary_sounds_filename = elementary_sounds_filename
+
+        self.store_relationships = store_relationships
+
+        # Scene length distribution of the constructive sampler. Calibrated before the generation
+        self.constructive_length_cdf = None
+
+        # Random number generator used to sample the scenes. Default to the global numpy generator.
+        # Replaced by a generator seeded from the shard index when doing sharded generation
+        self.rng = np.random
+
+        # Index of the next shard to generate. Restored from the generation state when appending to an existing set
+        self.next_shard_index = 0
+
+        # Scenes already generated (When appending to an existing set). New scenes must not duplicate them
+        self.existing_scenes_index = None
+
         with open(metadata_filepath) as metadata:
             self.attributes_values = {key: val['values'] for key, val in json.load(metadata)['attributes'].items()}
 
-        self.elementary_sounds = Elementary_Sounds(elementary_sounds_folderpath, elementary_sounds_definition_filename)
+        self.elementary_sounds = Elementary_Sounds(elementary_sounds_folderpath, elementary_sounds_definition_filename,
+                                                   use_analysis_cache=use_analysis_cache,
+                                                   analysis_nb_process=analysis_nb_process)
 
         self.nb_objects_per_scene = {
             'min': min_nb_objects_per_scene,
@@ -131,25 +207,351 @@ class Scene_generator:
         self.constrained_attributes = ['brightness', 'loudness']
 
         # Stats
-        self.stats = {
+        self.stats = self._create_stats()
+        self.progress_every = progress_every
+
+        # Progress is checked in the candidates loops. Set when the generation start
+        self.progress_start_time = None
+        self.last_progress_time = None
+        self.progress_prefix = ''
+
+    def _create_stats(self):
+        """
+        Counters filled during the generation
+          - nbCandidates          : Number of candidate scenes drawn
+          - nbValid               : Number of candidates that satisfied all the constraints
+          - nbDuplicates          : Number of candidates rejected because they were already generated
+          - nbTooLong             : Number of candidates rejected by the duration constraint
+          - nbMissingFamilies     : Number of candidates rejected by the 'min_nb_families' constraint
+          - nbMissingObjectPerFam : Number of candidates rejected by the 'min_objects_per_family' constraint
+          - attribute_constraint  : Number of candidates rejected by the 'min_ratio_for_attribute' constraint
+                                    (Missing values or ratio under the threshold) for each constrained attribute
+          - time                  : Time spent (In seconds) in each step of the generation
+        A candidate is only counted in the first constraint it doesn't satisfy
+        """
+        return {
             'levels': {},
+            'nbCandidates': 0,
             'nbValid': 0,
+            'nbDuplicates': 0,
+            'nbTooLong': 0,
             'nbMissingFamilies': 0,
             'nbMissingObjectPerFam': 0,
-            'attribute_constraint': {}
+            'attribute_constraint': {attribute: {'missing_values': 0, 'ratio': 0}
+                                     for attribute in self.constrained_attributes},
+            'time': {
+                'calibration': 0.0,
+                'sampling': 0.0,
+                'validation': 0.0,
+                'scene_creation': 0.0,
+                'writing': 0.0
+            }
         }
 
+    @staticmethod
+    def _merge_stats(stats, other_stats):
+        """
+        Add the counters of {other_stats} to {stats}
+        """
+        for key, value in other_stats.items():
+            if isinstance(value, dict):
+                Scene_generator._merge_stats(stats.setdefault(key, {}), value)
+            elif isinstance(value, (int, float)) and key in stats:
+                stats[key] += value
+            else:
+                stats[key] = value
+
+    def get_stats_summary(self):
+        """
+        Generation stats with the throughput and acceptance rate
+        The 'total' time is measured while iterating over the generated scenes. When the scenes are streamed to the
+        writers, it include the scene creation and writing time
+        """
+        total_time = max(self.stats['time'].get('total', 0), 1e-6)
+
+        summary = dict(self.stats)
+        summary['candidates_per_sec'] = self.stats['nbCandidates'] / total_time
+        summary['accepted_per_sec'] = self.stats.get('nbGenerated', 0) / total_time
+        summary['acceptance_rate'] = self.stats['nbValid'] / max(self.stats['nbCandidates'], 1)
+        summary['constraints'] = self.constraints
+        summary['nb_objects_per_scene'] = self.nb_objects_per_scene
+        summary['sampling_method'] = self.sampling_method
+
+        return summary
+
+    def _print_progress(self, nb_generated, nb_to_generate, elapsed_time):
+        attributes_rejections = ', '.join("%s %d missing values %d ratio" % (attribute, counters['missing_values'],
+                                                                             counters['ratio'])
+                                          for attribute, counters in self.stats['attribute_constraint'].items())
+
+        print("%sGenerated %d/%d scenes. %d candidates (%.1f candidates/sec, %.1f accepted/sec). "
+              "Rejected : %d duplicates, %d too long, %d missing families, %d missing objects per family, %s" % (
+               self.progress_prefix, nb_generated, nb_to_generate, self.stats['nbCandidates'],
+               self.stats['nbCandidates'] / max(elapsed_time, 1e-6), nb_generated / max(elapsed_time, 1e-6),
+               self.stats['nbDuplicates'], self.stats['nbTooLong'], self.stats['nbMissingFamilies'],
+               self.stats['nbMissingObjectPerFam'], attributes_rejections), flush=True)
+
+    def _check_progress(self, nb_generated, nb_to_generate):
+        """
+        Print the progress if more than {self.progress_every} seconds passed since the last print
+        Called in the candidates loops so that the progress is printed even when no candidate is accepted
+        """
+        if self.progress_start_time is None:
+            return
+
+        current_time = time.time()
+        if current_time - self.last_progress_time > self.progress_every:
+            self._print_progress(nb_generated, nb_to_generate, current_time - self.progress_start_time)
+            self.last_progress_time = current_time
+
     def _scene_id_list_to_sound_list(self, scene_id_list):
         return [self.elementary_sounds.get(idx) for idx in scene_id_list]
 
     def _generate_scene_id_list(self):
         # Shuffle all sounds and pick the first 'nb_objects_per_scene' as the scene
-        np.random.shuffle(self.elementary_sounds.id_list_shuffled)
+        self.rng.shuffle(self.elementary_sounds.id_list_shuffled)
 
-        nb_sound = np.random.randint(self.nb_objects_per_scene['min'], self.nb_objects_per_scene['max'] + 1)
+        nb_sound = self.rng.randint(self.nb_objects_per_scene['min'], self.nb_objects_per_scene['max'] + 1)
 
         return self.elementary_sounds.id_list_shuffled[:nb_sound]
 
+    def _get_min_count_for_attribute(self, nb_sound):
+        """
+        Minimum number of occurence of an attribute value present in a scene of {nb_sound} objects
+        (Smallest count for which the 'min_ratio_for_attribute' constraint of _validate_scene is satisfied)
+        """
+        min_count = 1
+        while min_count / nb_sound <= self.constraints['min_ratio_for_attribute']:
+            min_count += 1
+
+        return min_count
+
+    def _prepare_constructive_sampling(self):
+        """
+        Index used by _generate_scene_id_batch_constructive
+          - The sounds of each family and their position in {constructive_sounds_by_family}
+          - The code of each constrained attribute for each sound and the codes that can be absent from a scene
+          - The minimum count of an attribute value for each scene length
+        """
+        nb_heavy_families = self.constraints['min_nb_families_subject_to_min_objects_per_family']
+        families_size = np.bincount(self.elementary_sounds.family_codes, minlength=self.elementary_sounds.nb_families)
+        nb_eligible_families = np.count_nonzero(families_size >= self.constraints['min_objects_per_family'])
+
+        if nb_heavy_families > nb_eligible_families:
+            raise ValueError("Can't satisfy the 'min_nb_families_subject_to_min_objects_per_family' constraint. "
+                             "%d families have at least %d sounds, %d are required" % (
+                              nb_eligible_families, self.constraints['min_objects_per_family'], nb_heavy_families))
+
+        self.constructive_families_size = families_size
+        self.constructive_families_offset = np.concatenate([[0], np.cumsum(families_size)[:-1]])
+        self.constructive_sounds_by_family = np.argsort(self.elementary_sounds.family_codes, kind='mergesort')
+
+        # Each value (except None) of the constrained attributes must be present in the scene
+        self.constructive_attributes_codes = []
+        self.constructive_optional_codes = []
+        for constrained_attribute in self.constrained_attributes:
+            codes, values = self.elementary_sounds.get_attribute_codes(constrained_attribute)
+            self.constructive_attributes_codes.append(codes)
+            self.constructive_optional_codes.append(np.array([value is None for value in values]))
+
+        max_length = min(self.nb_objects_per_scene['max'], self.elementary_sounds.nb_sounds)
+        self.constructive_min_count = np.array([self._get_min_count_for_attribute(max(nb_sound, 1))
+                                                for nb_sound in range(max_length + 1)])
+
+    def _calibrate_constructive_sampling(self, nb_candidates=4096):
+        """
+        The rejection sampler draw the scene length uniformly, the length of its accepted scenes is distributed
+        proportionally to the acceptance rate of each length. The constructive sampler accept each length at a
+        different rate, it draw the scene length with a probability proportional to
+        (rejection acceptance rate / constructive acceptance rate) so that the accepted scenes have the same length
+        distribution as with the rejection sampler.
+        Both acceptance rates are estimated on {nb_candidates} candidates of each length drawn from a fixed random
+        stream so the probabilities don't depend on the seed or on the shard. They are not counted in the stats
+        """
+        start_time = time.time()
+        self._prepare_constructive_sampling()
+
+        rng, stats = self.rng, self.stats
+        self.rng = np.random.RandomState(0)
+        self.stats = self._create_stats()
+
+        nb_sounds = self.elementary_sounds.nb_sounds
+        id_array = np.array(self.elementary_sounds.id_list)
+        lengths = range(self.nb_objects_per_scene['min'], min(self.nb_objects_per_scene['max'], nb_sounds) + 1)
+        length_proba = np.zeros(len(lengths))
+
+        for length_idx, nb_sound in enumerate(lengths):
+            # Acceptance rate of the rejection sampler (Candidates drawn as in _generate_scene_id_batch)
+            id_matrix = id_array[np.argsort(self.rng.rand(nb_candidates, nb_sounds), axis=1)[:, :nb_sound]]
+            valid = self._validate_scene_batch(id_matrix, np.full(nb_candidates, nb_sound),
+                                               np.ones(id_matrix.shape, dtype=bool))
+            rejection_acceptance = np.count_nonzero(valid) / nb_candidates
+
+            if rejection_acceptance == 0:
+                continue
+
+            valid = self._validate_scene_batch(*self._generate_scene_id_batch_constructive(
+                nb_candidates, np.full(nb_candidates, nb_sound)))
+            constructive_acceptance = np.count_nonzero(valid) / nb_candidates
+
+            if constructive_acceptance == 0:
+                print("[WARNING] The constructive sampler can't build valid scenes of %d objects. "
+                      "They won't be generated" % nb_sound)
+                continue
+
+            length_proba[length_idx] = rejection_acceptance / constructive_acceptance
+
+        self.rng, self.stats = rng, stats
+        self.stats['time']['calibration'] = time.time() - start_time
+
+        if np.sum(length_proba) == 0:
+            raise ValueError("No valid scene were found while calibrating the constructive sampler. "
+                             "The constraints can't be satisfied with %d to %d objects per scene" % (
+                              self.nb_objects_per_scene['min'], self.nb_objects_per_scene['max']))
+
+        self.constructive_length_cdf = np.cumsum(length_proba)
+        self.constructive_length_cdf /= self.constructive_length_cdf[-1]
+
+        print("Calibrated the constructive sampling in %.2f sec" % self.stats['time']['calibration'])
+
+    def _generate_scene_id_batch_constructive(self, batch_size, lengths=None):
+        """
+        Build {batch_size} candidate scenes that satisfy the families and attributes constraints by construction
+        Same output as _generate_scene_id_batch. The sounds of all the candidates are picked at once, position by
+        position :
+          1. Pick the families subject to the 'min_objects_per_family' constraint and sample their sounds
+          2. Pick the other families required by 'min_nb_families' and sample one sound for each
+          3. Fill the rest of the scene
+        Each sound is sampled uniformly from the sounds that keep the 'min_ratio_for_attribute' constraint reachable
+        with the remaining objects (Each value must reach its minimum count and a value can't be added if there is
+        not enough room left to bring it to its minimum count). The sounds of each candidate are then shuffled so that
+        the position of a sound doesn't depend on the step that selected it.
+
+        Families are picked with a probability proportional to their number of sounds to stay close to the rejection
+        sampler. The scene lengths are drawn from {self.constructive_length_cdf} (See _calibrate_constructive_sampling)
+        The candidates must still be validated since the duration constraint is not enforced by construction and the
+        attributes counts can get stuck when a combination of values is exhausted
+        """
+        nb_sounds = self.elementary_sounds.nb_sounds
+        max_length = min(self.nb_objects_per_scene['max'], nb_sounds)
+        rows = np.arange(batch_size)
+
+        if lengths is None:
+            lengths = np.searchsorted(self.constructive_length_cdf, self.rng.rand(batch_size), side='right')
+            lengths += self.nb_objects_per_scene['min']
+
+        min_count = self.constructive_min_count[lengths][:, np.newaxis]
+        available = np.ones((batch_size, nb_sounds), dtype=bool)
+        attributes_count = [np.zeros((batch_size, len(optional_codes)), dtype=np.int64)
+                            for optional_codes in self.constructive_optional_codes]
+        id_matrix = np.zeros((batch_size, max_length), dtype=np.int64)
+
+        def get_allowed_codes(candidate_rows, position):
+            # Codes of each constrained attribute that can be added to the candidates
+            nb_remaining = (lengths[candidate_rows] - position)[:, np.newaxis]
+            allowed_codes = []
+            for optional_codes, count in zip(self.constructive_optional_codes, attributes_count):
+                # Number of objects still needed for the values to reach their minimum count. Adding a sound reduce
+                # it if its value is missing, increase it if its value was not in the scene (Only for None values)
+                count = count[candidate_rows]
+                row_min_count = min_count[candidate_rows]
+                missing = np.where((count > 0) | ~optional_codes, np.maximum(row_min_count - count, 0), 0)
+                delta = np.where(missing > 0, -1, np.where(count == 0, row_min_count - 1, 0))
+                allowed_codes.append(missing.sum(axis=1, keepdims=True) + delta < nb_remaining)
+
+            return allowed_codes
+
+        def is_allowed(candidate_rows, sound_ids, allowed_codes):
+            allowed = available[candidate_rows, sound_ids]
+            for codes, codes_allowed in zip(self.constructive_attributes_codes, allowed_codes):
+                allowed &= codes_allowed[np.arange(len(candidate_rows)), codes[sound_ids]]
+
+            return allowed
+
+        def pick_sounds(position, families=None):
+            """
+            Pick the sound at {position} of the candidates long enough. The sound is drawn uniformly from the sounds of
+            {families} (One family for each candidate) or from all the sounds until an allowed sound is found.
+            The allowed sounds of the remaining candidates are then listed
+            """
+            pending_rows = rows[position < lengths]
+            pending_allowed_codes = get_allowed_codes(pending_rows, position)
+
+            for _ in range(8):
+                if len(pending_rows) == 0:
+                    break
+
+                if families is None:
+                    sound_ids = (self.rng.rand(len(pending_rows)) * nb_sounds).astype(np.int64)
+                else:
+                    pending_families = families[pending_rows]
+                    sound_ids = self.constructive_sounds_by_family[
+                        self.constructive_families_offset[pending_families] +
+                        (self.rng.rand(len(pending_rows)) *
+                         self.constructive_families_size[pending_families]).astype(np.int64)]
+
+                allowed = is_allowed(pending_rows, sound_ids, pending_allowed_codes)
+                add_sounds(pending_rows[allowed], sound_ids[allowed], position)
+
+                pending_rows = pending_rows[~allowed]
+                pending_allowed_codes = [codes_allowed[~allowed] for codes_allowed in pending_allowed_codes]
+
+            if len(pending_rows) > 0:
+                allowed = available[pending_rows]
+                if families is not None:
+                    allowed &= self.elementary_sounds.family_codes == families[pending_rows, np.newaxis]
+                for codes, codes_allowed in zip(self.constructive_attributes_codes, pending_allowed_codes):
+                    allowed &= codes_allowed[:, codes]
+
+                # Stuck candidates pick any sound. They will be rejected by the validation
+                stuck = ~allowed.any(axis=1)
+                allowed[stuck] = available[pending_rows[stuck]]
+
+                # Uniform choice among the allowed sounds
+                cumulative_count = np.cumsum(allowed, axis=1)
+                picked_rank = (self.rng.rand(len(pending_rows)) * cumulative_count[:, -1]).astype(np.int64)
+                add_sounds(pending_rows, np.argmax(cumulative_count > picked_rank[:, np.newaxis], axis=1), position)
+
+        def add_sounds(candidate_rows, sound_ids, position):
+            id_matrix[candidate_rows, position] = sound_ids
+            available[candidate_rows, sound_ids] = False
+            for codes, count in zip(self.constructive_attributes_codes, attributes_count):
+                count[candidate_rows, codes[sound_ids]] += 1
+
+        # Families picked with a probability proportional to their size, without replacement (Weighted random keys)
+        nb_families = len(self.constructive_families_size)
+        nb_heavy_families = self.constraints['min_nb_families_subject_to_min_objects_per_family']
+        nb_light_families = min(max(self.constraints['min_nb_families'] - nb_heavy_families, 0),
+                                nb_families - nb_heavy_families)
+        can_be_heavy = self.constructive_families_size >= self.constraints['min_objects_per_family']
+
+        families_keys = self.rng.rand(batch_size, nb_families) ** (1 / self.constructive_families_size)
+        heavy_families = np.argsort(-np.where(can_be_heavy, families_keys, -1), axis=1)[:, :nb_heavy_families]
+        families_keys[rows[:, np.newaxis], heavy_families] = -1
+        light_families = np.argsort(-families_keys, axis=1)[:, :nb_light_families]
+
+        position = 0
+        for family_column in range(nb_heavy_families):
+            for _ in range(self.constraints['min_objects_per_family']):
+                if position < max_length:
+                    pick_sounds(position, heavy_families[:, family_column])
+                    position += 1
+
+        for family_column in range(nb_light_families):
+            if position < max_length:
+                pick_sounds(position, light_families[:, family_column])
+                position += 1
+
+        for position in range(position, max_length):
+            pick_sounds(position)
+
+        # Shuffle the sounds of each candidate
+        mask = np.arange(max_length)[np.newaxis, :] < lengths[:, np.newaxis]
+        order = np.argsort(np.where(mask, self.rng.rand(batch_size, max_length), 2), axis=1)
+        id_matrix = np.array(self.elementary_sounds.id_list)[id_matrix[rows[:, np.newaxis], order]]
+
+        return id_matrix, lengths, mask
+
     def _validate_scene(self, scene_objects):
         nb_object_in_scene = len(scene_objects)
 
@@ -157,12 +559,14 @@ class Scene_generator:
         total_sound_duration = sum([s['duration'] for s in scene_objects])
 
         if self.scene_duration['min'] <= total_sound_duration >= self.scene_duration['max']:
+            self.stats['nbTooLong'] += 1
             return False
 
         # Validate min_nb_families constraint
         families_count, current_nb_families = self.elementary_sounds.sounds_to_families_count(scene_objects)
 
         if current_nb_families < self.constraints['min_nb_families']:
+            self.stats['nbMissingFamilies'] += 1
             return False
 
         # Validate that we have the minimum objects per families
@@ -170,6 +574,7 @@ class Scene_generator:
                                     if count >= self.constraints['min_objects_per_family']])
 
         if valid_families_count < self.constraints['min_nb_families_subject_to_min_objects_per_family']:
+            self.stats['nbMissingObjectPerFam'] += 1
             return False
 
         # Validate the attributes distribution
@@ -185,35 +590,317 @@ class Scene_generator:
             # Must have at least 1 occurence of each attribute (Without counting None values)
             nb_vals_except_none = len(set(groups.keys()) - {None})
             if nb_vals_except_none < len(self.attributes_values[constrained_attribute]):
+                self.stats['attribute_constraint'][constrained_attribute]['missing_values'] += 1
                 return False
 
             # Verify that the frequencies validate the constraints
             for key, group in groups.items():
                 if len(group)/nb_object_in_scene <= self.constraints['min_ratio_for_attribute']:     # FIXME : nb_object
+                    self.stats['attribute_constraint'][constrained_attribute]['ratio'] += 1
                     return False
 
+        self.stats['nbValid'] += 1
         return True
 
-    def _generate_scenes(self, nb_to_generate):
-        processed_ids = defaultdict(lambda: False)
-        valid_ids = defaultdict(lambda: False)
-        scenes = []
+    def _generate_scene_id_batch(self, batch_size):
+        """
+        Draw {batch_size} candidate scenes at once
+        Each row of the returned matrix is the beginning of a random permutation of the sound ids.
+        Only the first {lengths[row]} ids of each row are part of the candidate scene (See {mask})
+        """
+        nb_sounds = self.elementary_sounds.nb_sounds
+        max_length = min(self.nb_objects_per_scene['max'], nb_sounds)
+
+        # Sorting uniform noise give an independent random permutation for each row
+        permutations = np.argsort(self.rng.rand(batch_size, nb_sounds), axis=1)[:, :max_length]
+        id_matrix = np.array(self.elementary_sounds.id_list)[permutations]
+
+        lengths = self.rng.randint(self.nb_objects_per_scene['min'], self.nb_objects_per_scene['max'] + 1,
+                                   size=batch_size)
+        lengths = np.minimum(lengths, max_length)
+
+        mask = np.arange(max_length)[np.newaxis, :] < lengths[:, np.newaxis]
+
+        return id_matrix, lengths, mask
+
+    @staticmethod
+    def _count_codes_per_row(code_matrix, mask, nb_codes):
+        """
+        Count the occurence of each code in each row of {code_matrix} (Only for the positions selected by {mask})
+        """
+        nb_rows = code_matrix.shape[0]
+        row_offsets = np.arange(nb_rows)[:, np.newaxis] * nb_codes
+
+        counts = np.bincount((code_matrix + row_offsets)[mask], minlength=nb_rows * nb_codes)
+
+        return counts.reshape(nb_rows, nb_codes)
+
+    def _validate_scene_batch(self, id_matrix, lengths, mask):
+        """
+        Vectorized version of _validate_scene. Return a boolean array indicating which candidate scenes are valid
+        """
+        valid = np.ones(id_matrix.shape[0], dtype=bool)
+
+        def apply_constraint(satisfied, counter_dict, counter_key):
+            # Candidates are only counted in the first constraint they don't satisfy
+            counter_dict[counter_key] += int(np.count_nonzero(valid & ~satisfied))
+            valid[:] &= satisfied
+
+        # Validate duration constraint
+        total_sound_duration = np.where(mask, self.elementary_sounds.durations[id_matrix], 0).sum(axis=1)
+        apply_constraint(~((self.scene_duration['min'] <= total_sound_duration) &
+                           (total_sound_duration >= self.scene_duration['max'])), self.stats, 'nbTooLong')
+
+        # Validate min_nb_families constraint
+        families_count = self._count_codes_per_row(self.elementary_sounds.family_codes[id_matrix], mask,
+                                                   self.elementary_sounds.nb_families)
+        apply_constraint(np.count_nonzero(families_count, axis=1) >= self.constraints['min_nb_families'],
+                         self.stats, 'nbMissingFamilies')
+
+        # Validate that we have the minimum objects per families
+        valid_families_count = np.count_nonzero(families_count >= self.constraints['min_objects_per_family'], axis=1)
+        apply_constraint(valid_families_count >= self.constraints['min_nb_families_subject_to_min_objects_per_family'],
+                         self.stats, 'nbMissingObjectPerFam')
+
+        # Validate the attributes distribution
+        for constrained_attribute in self.constrained_attributes:
+            attribute_stats = self.stats['attribute_constraint'][constrained_attribute]
+            codes, values = self.elementary_sounds.get_attribute_codes(constrained_attribute)
+            attribute_count = self._count_codes_per_row(codes[id_matrix], mask, len(values))
+            is_present = attribute_count > 0
+
+            # Must have at least 1 occurence of each attribute (Without counting None values)
+            not_none_codes = [code for code, value in enumerate(values) if value is not None]
+            nb_vals_except_none = np.count_nonzero(is_present[:, not_none_codes], axis=1)
+            apply_constraint(nb_vals_except_none >= len(self.attributes_values[constrained_attribute]),
+                             attribute_stats, 'missing_values')
+
+            # Verify that the frequencies validate the constraints
+            ratios = attribute_count / np.maximum(lengths, 1)[:, np.newaxis]
+            apply_constraint(~np.any(is_present & (ratios <= self.constraints['min_ratio_for_attribute']), axis=1),
+                             attribute_stats, 'ratio')
+
+        self.stats['nbValid'] += int(np.count_nonzero(valid))
+
+        return valid
+
+    def _create_dedup_index(self):
+        if self.existing_scenes_index is not None:
+            return self.existing_scenes_index.copy()
+
+        return Scene_Dedup_Index(self.elementary_sounds.nb_sounds)
+
+    def index_existing_scenes(self, scenes):
+        """
+        Register the scenes of an existing set so that they are not generated again
+        The objects of {scenes} can be full or compact since only their 'id' is used
+        """
+        if self.existing_scenes_index is None:
+            self.existing_scenes_index = Scene_Dedup_Index(self.elementary_sounds.nb_sounds)
+
+        for scene in scenes:
+            self.existing_scenes_index.add([obj['id'] for obj in scene['objects']])
+
+    def _iter_scenes_batched(self, nb_to_generate, dedup_index=None):
+        if dedup_index is None:
+            dedup_index = Scene_Dedup_Index(self.elementary_sounds.nb_sounds)
+
+        if self.sampling_method == 'constructive':
+            if self.constructive_length_cdf is None:
+                self._calibrate_constructive_sampling()
+            generate_scene_id_batch = self._generate_scene_id_batch_constructive
+        else:
+            generate_scene_id_batch = self._generate_scene_id_batch
+
+        timing = self.stats['time']
         counter = 0
 
         while counter < nb_to_generate:
+            self._check_progress(counter, nb_to_generate)
+
+            step_start = time.perf_counter()
+            id_matrix, lengths, mask = generate_scene_id_batch(self.sampling_batch_size)
+            self.stats['nbCandidates'] += self.sampling_batch_size
+            timing['sampling'] += time.perf_counter() - step_start
+
+            step_start = time.perf_counter()
+            valid_rows = np.flatnonzero(self._validate_scene_batch(id_matrix, lengths, mask))
+            timing['validation'] += time.perf_counter() - step_start
+
+            # Only the accepted candidates are converted to sound lists
+            for row in valid_rows:
+                scene_id_list = id_matrix[row, :lengths[row]].tolist()
+
+                if dedup_index.add(scene_id_list):
+                    counter += 1
+                    yield self._scene_id_list_to_sound_list(scene_id_list)
+
+                    if counter == nb_to_generate:
+                        break
+                else:
+                    self.stats['nbDuplicates'] += 1
+
+        self.stats['dedup_index'] = dedup_index.get_stats()
+
+    def _iter_scenes(self, nb_to_generate, dedup_index=None):
+        """
+        Yield {nb_to_generate} valid scenes as they are generated
+        The scenes already in {dedup_index} are rejected as duplicates
+        """
+        if self.sampling_method in ['batched', 'constructive']:
+            yield from self._iter_scenes_batched(nb_to_generate, dedup_index)
+            return
+
+        # Only the accepted scenes are indexed. A rejected candidate drawn again will be rejected again
+        if dedup_index is None:
+            dedup_index = Scene_Dedup_Index(self.elementary_sounds.nb_sounds)
+
+        timing = self.stats['time']
+        counter = 0
+
+        while counter < nb_to_generate:
+            self._check_progress(counter, nb_to_generate)
+
+            step_start = time.perf_counter()
             scene_id_list = self._generate_scene_id_list()
-            hashmap_index = str(scene_id_list)
-            scene_objects = self._scene_id_list_to_sound_list(scene_id_list)
+            self.stats['nbCandidates'] += 1
+            timing['sampling'] += time.perf_counter() - step_start
+
+            if scene_id_list not in dedup_index:
+                step_start = time.perf_counter()
+                scene_objects = self._scene_id_list_to_sound_list(scene_id_list)
+                is_valid = self._validate_scene(scene_objects)
+                timing['validation'] += time.perf_counter() - step_start
+
+                if is_valid:
+                    dedup_index.add(scene_id_list)
+                    counter += 1
+                    yield scene_objects
+            else:
+                self.stats['nbDuplicates'] += 1
+
+        self.stats['dedup_index'] = dedup_index.get_stats()
+
+    def _generate_scenes(self, nb_to_generate):
+        return list(self._iter_scenes(nb_to_generate))
+
+    def _generate_shard(self, random_seed, shard_index, nb_to_generate):
+        """
+        Generate the scenes of one shard using a random stream derived from {random_seed} and {shard_index}
+        The scenes generated by a shard only depend on those parameters (A smaller {nb_to_generate} give a prefix of
+        the scenes of a bigger one) which make the sharded generation independent of the number of process
+        Return the scenes and the stats of the shard
+        """
+        self.rng = np.random.RandomState([random_seed, shard_index])
+        self.elementary_sounds.id_list_shuffled = self.elementary_sounds.id_list.copy()
+        self.stats = self._create_stats()
+
+        # The progress of the shard is printed by the process generating it
+        progress_state = (self.progress_start_time, self.last_progress_time, self.progress_prefix)
+        self.progress_start_time = self.last_progress_time = time.time()
+        self.progress_prefix = 'Shard %d : ' % shard_index
+
+        shard_scenes = self._generate_scenes(nb_to_generate)
+
+        self.progress_start_time, self.last_progress_time, self.progress_prefix = progress_state
+
+        return shard_scenes, self.stats
+
+    def _wait_shard_result(self, shards_results, nb_generated, nb_to_generate):
+        """
+        Return the next shard generated by the processes ({shards_results} from Pool.imap)
+        The progress is checked while waiting. The counters only include the shards already merged
+        """
+        while True:
+            try:
+                return shards_results.next(timeout=1)
+            except TimeoutError:
+                self._check_progress(nb_generated, nb_to_generate)
+
+    def _iter_scenes_sharded(self, nb_to_generate, random_seed, nb_process, scenes_per_shard):
+        """
+        Distribute the generation of the scenes in shards across {nb_process} processes
+        The shards are merged in order and the duplicates across shards are removed. Extra shards are generated
+        until we got {nb_to_generate} scenes. The shards indexes start at {self.next_shard_index}
+        """
+        dedup_index = self._create_dedup_index()
+        sharded_stats = self.stats
+        counter = 0
+
+        pool = Pool(nb_process, initializer=_init_shard_worker, initargs=(self,)) if nb_process > 1 else None
+
+        try:
+            while counter < nb_to_generate:
+                nb_missing = nb_to_generate - counter
+                shards = []
+                while nb_missing > 0:
+                    shards.append((random_seed, self.next_shard_index, min(nb_missing, scenes_per_shard)))
+                    nb_missing -= scenes_per_shard
+                    self.next_shard_index += 1
+
+                if pool is not None:
+                    shards_results = pool.imap(_generate_shard_worker, shards)
+
+                for shard in shards:
+                    if pool is not None:
+                        shard_scenes, shard_stats = self._wait_shard_result(shards_results, counter, nb_to_generate)
+                    else:
+                        shard_scenes, shard_stats = self._generate_shard(*shard)
+
+                    del shard_stats['dedup_index']
+                    self._merge_stats(sharded_stats, shard_stats)
+                    self.stats = sharded_stats
+
+                    for scene in shard_scenes:
+                        if counter >= nb_to_generate:
+                            break
+
+                        if dedup_index.add([sound['id'] for sound in scene]):
+                            counter += 1
+                            yield scene
+                        else:
+                            self.stats['nbDuplicates'] += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.stats = sharded_stats
+        self.stats['dedup_index'] = dedup_index.get_stats()
+
+    def _iter_generated_scenes(self, nb_to_generate, random_seed=None, nb_process=None, scenes_per_shard=2000):
+        """
+        Yield the generated scenes and keep track of the generation stats
+        Progress is printed every {self.progress_every} seconds
+        """
+        print("Starting Scenes Generation (%s sampling)" % self.sampling_method)
+        start_time = time.time()
+        self.progress_start_time = self.last_progress_time = start_time
+
+        if self.sampling_method == 'constructive' and self.constructive_length_cdf is None:
+            # Calibrated once, before the shards are distributed to the processes
+            self._calibrate_constructive_sampling()
+
+        if nb_process is not None:
+            scene_iterator = self._iter_scenes_sharded(nb_to_generate, random_seed, nb_process, scenes_per_shard)
+        else:
+            scene_iterator = self._iter_scenes(nb_to_generate, self._create_dedup_index())
 
-            if not processed_ids[hashmap_index]:
-                processed_ids[hashmap_index] = True
-                if not valid_ids[hashmap_index]:
-                    if self._validate_scene(scene_objects):
-                        valid_ids[hashmap_index] = True
-                        scenes.append(scene_objects)
-                        counter += 1
+        nb_generated = 0
 
-        return scenes
+        for scene in scene_iterator:
+            nb_generated += 1
+            yield scene
+
+        generation_time = time.time() - start_time
+        self.stats['nbGenerated'] = nb_generated
+        self.stats['time']['total'] = generation_time
+
+        self._print_progress(nb_generated, nb_to_generate, generation_time)
+        print("Generated %d scenes in %.2f sec (%.1f scenes/sec)" % (nb_generated, generation_time,
+                                                                      nb_generated / max(generation_time, 1e-6)))
+        print("Duplicate index : %d scenes, %.2f MB" % (self.stats['dedup_index']['nb_scenes'],
+                                                        self.stats['dedup_index']['memory_footprint'] / 1e6))
 
     def _assign_silence_informations(self, scene):
         nb_sound = len(scene)
@@ -245,16 +932,13 @@ class Scene_generator:
 
         random.shuffle(silence_intervals)
 
-        for i, sound in enumerate(scene):
-          sound['silence_after'] = silence_intervals[i]
-
         # The rest of the silence duration should be added in the beginning of the scene
         silence_before = int(full_padding_duration - sum(silence_intervals))
 
-        return silence_before
+        return silence_before, silence_intervals
 
     def _generate_relationships(self, scene_composition):
-        # TODO : Those relationships are trivial. Could be moved to question engine (Before & after)
+        # NOTE : Those relationships are trivial. The question engine derive them from the objects position
         relationships = [
             {
                 'type': 'before',
@@ -280,77 +964,192 @@ class Scene_generator:
 
         return relationships
 
-    def generate(self, nb_to_generate, training_set_ratio=0.7, shuffle_scenes=True):
+    def get_info_section(self, set_type):
+        info = generate_info_section(set_type, self.version_nb)
 
-        print("Starting Scenes Generation")
+        if self.compact_scene_format:
+            info['scene_format'] = 'compact'
+            info['elementary_sounds_filename'] = self.elementary_sounds_filename
 
-        generated_scenes = self._generate_scenes(nb_to_generate)
+        return info
 
-        print("Generated %d scenes" % len(generated_scenes))
+    def write_elementary_sounds_definition(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump(self.elementary_sounds.definition, f, indent=2, sort_keys=True)
 
-        if shuffle_scenes:
-            np.random.shuffle(generated_scenes)
+    def _create_scene(self, generated_scene, set_type, set_index):
+        silence_before, silence_intervals = self._assign_silence_informations(generated_scene)
 
-        # Separating train, valid and test sets
-        nb_scene = len(generated_scenes)
+        # The shared sound records are only copied once the scene is accepted
+        if self.compact_scene_format:
+            objects = [{'id': sound['id'], 'silence_after': silence_after}
+                       for sound, silence_after in zip(generated_scene, silence_intervals)]
+        else:
+            objects = [sound.to_dict(silence_after=silence_after)
+                       for sound, silence_after in zip(generated_scene, silence_intervals)]
+
+        scene = {
+            "silence_before": silence_before,
+            "objects": objects,
+            "scene_index": '%.6d' % set_index,
+            "scene_filename": "CLEAR_%s_%06d.flac" % (set_type, set_index)
+        }
+
+        if self.store_relationships:
+            scene['relationships'] = self._generate_relationships(generated_scene)
+
+        return scene
+
+    def get_generation_settings(self):
+        """
+        Elementary sounds bank and scene format the generation state is valid for
+        """
+        return {
+            'nb_sounds': self.elementary_sounds.nb_sounds,
+            'elementary_sounds_hash': self.elementary_sounds.get_definition_hash(),
+            'compact_scene_format': self.compact_scene_format,
+            'store_relationships': self.store_relationships
+        }
+
+    def get_generation_state(self):
+        """
+        State of the random generators at the end of the generation. Used to continue the random streams when
+        appending scenes to an existing set
+        The legacy sampler shuffle the sounds ids in place, the shuffled list is therefore part of the state
+        The bank and the scene format are saved along the state so that it is not restored for different settings
+        """
+        numpy_state = np.random.get_state()
+        python_state = random.getstate()
+
+        return {
+            'numpy_random_state': [numpy_state[0], numpy_state[1].tolist()] + list(numpy_state[2:]),
+            'python_random_state': [python_state[0], list(python_state[1]), python_state[2]],
+            'id_list_shuffled': [int(idx) for idx in self.elementary_sounds.id_list_shuffled],
+            'next_shard_index': self.next_shard_index,
+            'settings': self.get_generation_settings()
+        }
+
+    def restore_generation_state(self, state):
+        """
+        Raise a ValueError if the state was saved with a different elementary sounds bank or scene format
+        The ids of the existing scenes and the shuffled ids of the state would refer to different sounds
+        """
+        settings = self.get_generation_settings()
+        saved_settings = state.get('settings')
+
+        if saved_settings is None:
+            print("[WARNING] The generation state doesn't contain the elementary sounds bank it was saved with. "
+                  "Can't verify that the existing scenes refer to the same sounds")
+            if sorted(state['id_list_shuffled']) != sorted(self.elementary_sounds.id_list):
+                raise ValueError("The generation state was saved with a different elementary sounds bank "
+                                 "(%d sounds, %d loaded)" % (len(state['id_list_shuffled']),
+                                                             self.elementary_sounds.nb_sounds))
+        else:
+            mismatches = ["%s (Saved : %s, current : %s)" % (key, saved_settings.get(key), value)
+                          for key, value in settings.items() if saved_settings.get(key) != value]
+            if len(mismatches) > 0:
+                raise ValueError("The generation state was saved with different settings : %s" % ', '.join(mismatches))
+
+        numpy_state = state['numpy_random_state']
+        np.random.set_state((numpy_state[0], np.array(numpy_state[1], dtype=np.uint32)) + tuple(numpy_state[2:]))
+
+        python_state = state['python_random_state']
+        random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+
+        self.elementary_sounds.id_list_shuffled[:] = state['id_list_shuffled']
+        self.next_shard_index = state['next_shard_index']
+
+    @staticmethod
+    def _get_sets_size(nb_scene, training_set_ratio):
         nb_training = round(nb_scene*training_set_ratio)
         valid_and_test_ratio = (1.0 - training_set_ratio) / 2
         nb_valid = round(nb_scene*valid_and_test_ratio)
         nb_test = nb_scene - nb_training - nb_valid
 
-        training_scenes = []
-        valid_scenes = []
-        test_scenes = []
+        return {
+            'train': nb_training,
+            'val': nb_valid,
+            'test': nb_test
+        }
 
-        training_index = 0
-        valid_index = 0
-        test_index = 0
+    def generate(self, nb_to_generate, training_set_ratio=0.7, shuffle_scenes=True, random_seed=None,
+                 nb_process=None, scenes_per_shard=2000):
 
-        scene_count = 0
-        for generated_scene in generated_scenes:
-            silence_before = self._assign_silence_informations(generated_scene)
+        generated_scenes = list(self._iter_generated_scenes(nb_to_generate, random_seed, nb_process, scenes_per_shard))
 
-            scene = {
-                "silence_before": silence_before,
-                "objects": generated_scene,
-                "relationships": self._generate_relationships(generated_scene)
-            }
-
-            if scene_count < nb_training:
-                scene['scene_index'] = '%.6d' % training_index
-                scene['scene_filename'] = "CLEAR_train_%06d.flac" % training_index
-                training_index += 1
-                training_scenes.append(scene)
+        if shuffle_scenes:
+            np.random.shuffle(generated_scenes)
 
-            elif scene_count < nb_training + nb_valid:
-                scene['scene_index'] = '%.6d' % valid_index
-                scene['scene_filename'] = "CLEAR_val_%06d.flac" % valid_index
-                valid_index += 1
-                valid_scenes.append(scene)
+        # Separating train, valid and test sets
+        sets_size = self._get_sets_size(len(generated_scenes), training_set_ratio)
 
-            else:
-                scene['scene_index'] = '%.6d' % test_index
-                scene['scene_filename'] = "CLEAR_test_%06d.flac" % test_index
-                test_index += 1
-                test_scenes.append(scene)
+        scenes = {set_type: [] for set_type in sets_size.keys()}
 
-            scene_count += 1
+        step_start = time.perf_counter()
+        scene_count = 0
+        for set_type, set_size in sets_size.items():
+            for set_index in range(set_size):
+                scenes[set_type].append(self._create_scene(generated_scenes[scene_count], set_type, set_index))
+                scene_count += 1
+        self.stats['time']['scene_creation'] += time.perf_counter() - step_start
 
         return {
-            "train" : {
-                "info": generate_info_section('train', self.version_nb),
-                "scenes": training_scenes
-            },
-            "val": {
-                "info": generate_info_section('val', self.version_nb),
-                "scenes": valid_scenes
-            },
-            "test": {
-                "info": generate_info_section('test', self.version_nb),
-                "scenes": test_scenes
-            }
+            set_type: {
+                "info": self.get_info_section(set_type),
+                "scenes": set_scenes
+            } for set_type, set_scenes in scenes.items()
         }
 
+    def generate_to_writers(self, nb_to_generate, writers, training_set_ratio=0.7, random_seed=None,
+                            nb_process=None, scenes_per_shard=2000, sets_start_index=None):
+        """
+        Assign the scenes to a set and write them as soon as they are generated. Only keep the set assignment in memory
+        The set of each scene is randomly chosen beforehand, which is equivalent to shuffling the scenes before the
+        split done in generate()
+        The scene indexes of each set start at {sets_start_index} (Number of existing scenes when appending)
+        """
+        sets_size = self._get_sets_size(nb_to_generate, training_set_ratio)
+        set_types = list(sets_size.keys())
+
+        set_assignment = np.repeat(np.arange(len(set_types), dtype=np.int8), list(sets_size.values()))
+        np.random.shuffle(set_assignment)
+
+        sets_index = {set_type: 0 for set_type in set_types}
+        if sets_start_index is not None:
+            sets_index.update(sets_start_index)
+
+        scene_iterator = self._iter_generated_scenes(nb_to_generate, random_seed, nb_process, scenes_per_shard)
+        for scene_count, generated_scene in enumerate(scene_iterator):
+            set_type = set_types[set_assignment[scene_count]]
+
+            step_start = time.perf_counter()
+            scene = self._create_scene(generated_scene, set_type, sets_index[set_type])
+            self.stats['time']['scene_creation'] += time.perf_counter() - step_start
+
+            step_start = time.perf_counter()
+            writers[set_type].write(scene)
+            self.stats['time']['writing'] += time.perf_counter() - step_start
+
+            sets_index[set_type] += 1
+
+        step_start = time.perf_counter()
+        for writer in writers.values():
+            writer.close()
+        self.stats['time']['writing'] += time.perf_counter() - step_start
+
+
+# Sharded generation workers
+_shard_worker_scene_generator = None
+
+
+def _init_shard_worker(scene_generator):
+    global _shard_worker_scene_generator
+    _shard_worker_scene_generator = scene_generator
+
+
+def _generate_shard_worker(shard):
+    return _shard_worker_scene_generator._generate_shard(*shard)
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -361,7 +1160,11 @@ if __name__ == '__main__':
     if not os.path.isdir(experiment_output_folder):
         os.mkdir(experiment_output_folder)
 
-    if not os.path.isdir(scenes_output_folder):
+    if args.append:
+        if not os.path.isdir(scenes_output_folder):
+            print("Can't append to version '%s', no scenes were generated." % args.output_version_nb, file=sys.stderr)
+            exit(1)
+    elif not os.path.isdir(scenes_output_folder):
         os.mkdir(scenes_output_folder)
     elif args.clear_existing_files:
         rm_dir(scenes_output_folder)
@@ -381,6 +1184,33 @@ if __name__ == '__main__':
         print("The seed must be specified in the arguments.", file=sys.stderr)
         exit(1)
 
+    set_types = ['train', 'val', 'test']
+    existing_scenes = {}
+    if args.append:
+        # The new scenes are written using the layout and the objects format of the existing sets
+        existing_format = get_scene_file_format(get_scene_filepath(scenes_output_folder,
+                                                                   args.output_filename_prefix, 'train'))
+        if existing_format is None:
+            print("Can't find the existing scene files in '%s'." % scenes_output_folder, file=sys.stderr)
+            exit(1)
+        elif existing_format != args.output_format:
+            print("Appending to existing '%s' scene files" % existing_format)
+            args.output_format = existing_format
+
+        for set_type in set_types:
+            existing_scenes[set_type], existing_info = load_scene_file(
+                get_scene_filepath(scenes_output_folder, args.output_filename_prefix, set_type), expand_compact=False)
+
+        args.compact_scene_format = existing_info.get('scene_format') == 'compact'
+
+        # The relationships are only stored if the existing scenes have them
+        existing_first_scenes = [scenes[0] for scenes in existing_scenes.values() if len(scenes) > 0]
+        if len(existing_first_scenes) > 0:
+            store_relationships = 'relationships' in existing_first_scenes[0]
+            if store_relationships == args.no_relationships:
+                print("Appending %s the relationships of the scenes" % ('with' if store_relationships else 'without'))
+                args.no_relationships = not store_relationships
+
     scene_generator = Scene_generator(args.min_scene_length,
                                       args.max_scene_length,
                                       args.silence_padding_per_object,
@@ -391,17 +1221,94 @@ if __name__ == '__main__':
                                       args.constraint_min_nb_families,
                                       args.constraint_min_object_per_family,
                                       args.constraint_min_nb_families_subject_to_min_object_per_family,
-                                      args.constraint_min_ratio_for_attribute)
-
-    scenes = scene_generator.generate(nb_to_generate=args.nb_scene, training_set_ratio=args.training_set_ratio)
-
-    # Write to file
-    for set_type, scene_struct in scenes.items():
-        scenes_filename = '%s_%s_scenes.json' % (args.output_filename_prefix, set_type)
-
-        scenes_filepath = os.path.join(scenes_output_folder, scenes_filename)
-
-        with open(scenes_filepath, 'w') as f:
-            json.dump(scene_struct, f, indent=2, sort_keys=True)
+                                      args.constraint_min_ratio_for_attribute,
+                                      args.sampling_method,
+                                      args.sampling_batch_size,
+                                      args.compact_scene_format,
+                                      get_elementary_sounds_filename(args.output_filename_prefix),
+                                      not args.no_relationships,
+                                      args.progress_every,
+                                      not args.no_analysis_cache,
+                                      args.nb_process)
+
+    generation_state_filepath = get_generation_state_filepath(scenes_output_folder, args.output_filename_prefix)
+    sets_start_index = {set_type: len(existing_scenes.get(set_type, [])) for set_type in set_types}
+
+    if args.append:
+        if os.path.isfile(generation_state_filepath):
+            with open(generation_state_filepath, 'r') as f:
+                generation_state = json.load(f)
+
+            try:
+                scene_generator.restore_generation_state(generation_state)
+            except ValueError as error:
+                print("Can't append to version '%s'. %s" % (args.output_version_nb, error), file=sys.stderr)
+                exit(1)
+        else:
+            # Sets generated before the generation state was saved. Use new random streams derived from the number
+            # of existing scenes. Duplicates of existing scenes are still rejected
+            nb_existing_scenes = sum(sets_start_index.values())
+            print("No generation state found. Deriving the random streams from the number of existing scenes")
+            init_random_seed(args.random_nb_generator_seed + nb_existing_scenes)
+            scene_generator.next_shard_index = nb_existing_scenes
+
+        for set_type in set_types:
+            scene_generator.index_existing_scenes(existing_scenes[set_type])
+        del existing_scenes
+    elif args.compact_scene_format:
+        scene_generator.write_elementary_sounds_definition(
+            os.path.join(scenes_output_folder, get_elementary_sounds_filename(args.output_filename_prefix)))
+
+    if args.output_format == 'json' and not args.append:
+        scenes = scene_generator.generate(nb_to_generate=args.nb_scene,
+                                          training_set_ratio=args.training_set_ratio,
+                                          random_seed=args.random_nb_generator_seed,
+                                          nb_process=args.nb_process,
+                                          scenes_per_shard=args.scenes_per_shard)
+
+        # Write to file
+        for set_type, scene_struct in scenes.items():
+            scenes_filepath = get_scene_filepath(scenes_output_folder, args.output_filename_prefix, set_type)
+
+            with open(scenes_filepath, 'w') as f:
+                json.dump(scene_struct, f, indent=2, sort_keys=True)
+    else:
+        # Scenes are written to file as they are generated
+        writers = {}
+        for set_type in set_types:
+            writers[set_type] = create_scene_writer(args.output_format,
+                                                    get_scene_filepath(scenes_output_folder,
+                                                                       args.output_filename_prefix, set_type),
+                                                    scene_generator.get_info_section(set_type),
+                                                    args.scenes_per_chunk,
+                                                    append=args.append)
+
+        scene_generator.generate_to_writers(nb_to_generate=args.nb_scene,
+                                            writers=writers,
+                                            training_set_ratio=args.training_set_ratio,
+                                            random_seed=args.random_nb_generator_seed,
+                                            nb_process=args.nb_process,
+                                            scenes_per_shard=args.scenes_per_shard,
+                                            sets_start_index=sets_start_index)
+
+    # Save the random generators state to be able to append new scenes later
+    with open(generation_state_filepath, 'w') as f:
+        json.dump(scene_generator.get_generation_state(), f)
+
+    if args.append:
+        sets_size = scene_generator._get_sets_size(args.nb_scene, args.training_set_ratio)
+        print("New scenes (Use --scene_start_idx for the question generation and --produce_specific_scenes for the "
+              "audio production) :")
+        for set_type in set_types:
+            print("  %-5s : %d to %d" % (set_type, sets_start_index[set_type],
+                                         sets_start_index[set_type] + sets_size[set_type]))
+
+    # Write the generation stats
+    log_folder = os.path.join(experiment_output_folder, 'log')
+    if not os.path.isdir(log_folder):
+        os.mkdir(log_folder)
+
+    with open(os.path.join(log_folder, 'scene_generation_stats.json'), 'w') as f:
+        json.dump(scene_generator.get_stats_summary(), f, indent=2, sort_keys=True)
 
     print('done')
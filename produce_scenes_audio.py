@@ -9,15 +9,16 @@
 
 
 import sys, os, argparse, random
-from multiprocessing import Process, Queue
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from shutil import rmtree as rm_dir
 from datetime import datetime
-import time
+import traceback
+from functools import partial
 import gc
 
 import json
 from pydub import AudioSegment
-from pydub.utils import get_array_type
 import numpy as np
 import matplotlib
 
@@ -26,9 +27,18 @@ matplotlib.interactive(False)
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 
-from utils.audio_processing import add_reverberation, generate_random_noise
-from utils.misc import init_random_seed, pydub_audiosegment_to_float_array, float_array_to_pydub_audiosegment
+from utils.audio_processing import add_reverberation, add_reverberation_numpy, reverb_backends, \
+    generate_random_noise_samples
+from utils.misc import init_random_seed, get_derived_seed, get_sample_dtype, int_samples_to_float_array, \
+    float_array_to_int_samples, int_samples_to_pydub_audiosegment
 from utils.misc import save_arguments
+from utils.scene_io import load_scene_file
+from utils.sound_bank import Packed_Sound_Bank
+from utils.spectrogram import spectrogram_backends, compute_spectrogram, spectrogram_to_image, get_colormap_lut, \
+    write_png
+from utils.spectrogram_shards import Spectrogram_Shard_Writer, spectrogram_tensor_dtypes
+from utils.background_noise import Background_Noise_Bank
+from utils.impulse_responses import Impulse_Response_Bank, Reverberated_Sound_Cache
 
 """
 Arguments definition
@@ -41,6 +51,9 @@ parser.add_argument('--elementary_sounds_folder', default='../elementary_sounds'
 
 parser.add_argument('--elementary_sounds_definition_filename', default='elementary_sounds.json', type=str,
                     help='Filename of the JSON file listing the attributes of the elementary sounds')
+parser.add_argument('--packed_sound_bank', default='', type=str,
+                    help='Path of a packed sound bank created with scripts/pack_elementary_sounds.py. If set, the '
+                         'samples are memory mapped from the bank instead of decoding the WAV files')
 
 # Options
 parser.add_argument('--with_background_noise', action='store_true',
@@ -50,6 +63,11 @@ parser.add_argument('--background_noise_gain_range', default="-100,-20", type=st
                          'Should be written as 0,100 for a range from 0 to 100')
 parser.add_argument('--no_background_noise', action='store_true',
                     help='Override the --with_background_noise setting. If this is set, there will be no background noise.')
+parser.add_argument('--background_noise_bank_size', default=0, type=int,
+                    help='Number of noise buffers generated once and sliced at a random offset for each scene. '
+                         'If 0, a new noise is generated for each scene')
+parser.add_argument('--background_noise_bank_duration', default=60, type=int,
+                    help='Duration in seconds of each noise buffer of the background noise bank')
 
 parser.add_argument('--with_reverb', action='store_true',
                     help='Use this setting to include ramdom reverberations in the scenes')
@@ -59,6 +77,21 @@ parser.add_argument('--reverb_delay_range', default="0,500", type=str,
                     help='Range for the reverberation parameter. Should be written as 0,100 for a range from 0 to 100')
 parser.add_argument('--no_reverb', action='store_true',
                     help='Override the --with_reverb setting. If this is set, there will be no reverberation.')
+parser.add_argument('--reverb_backend', default='sox', type=str, choices=reverb_backends,
+                    help='Implementation of the reverberation. "sox" pipe each scene through a sox subprocess (pysndfx), '
+                         '"numpy" run the same comb/allpass network in process, "convolution" convolve the scenes with '
+                         'the impulse response of the numpy reverberation (Synthesized once per room scale)')
+parser.add_argument('--reverb_impulse_response_cache_size', default=32, type=int,
+                    help='Number of impulse responses kept in memory by each process with --reverb_backend convolution')
+parser.add_argument('--reverb_per_sound', action='store_true',
+                    help='With --reverb_backend convolution, the reverberation of each elementary sound is cached and '
+                         'mixed at the sound onset instead of reverberating the whole scene. '
+                         'The background noise is then added after the reverberation (It is not reverberated)')
+parser.add_argument('--reverb_sound_cache_size', default=512, type=int,
+                    help='Memory in MB used by each process to cache the reverberated sounds with --reverb_per_sound')
+parser.add_argument('--reverb_per_sound_room_scale_step', default=20, type=int,
+                    help='With --reverb_per_sound, the room scale is rounded down to a multiple of this step (From '
+                         'the minimum of --reverb_room_scale_range) so that the reverberated sounds are reused')
 
 parser.add_argument('--no_audio_files', action='store_true',
                     help='If set, audio file won\'t be produced. '
@@ -74,6 +107,19 @@ parser.add_argument('--spectrogram_window_length', default=1024, type=int,
                     help='Number of samples used in the FFT window')
 parser.add_argument('--spectrogram_window_overlap', default=512, type=int,
                     help='Number of samples that are overlapped in the FFT window')
+parser.add_argument('--spectrogram_backend', default='matplotlib', type=str, choices=spectrogram_backends,
+                    help='Implementation of the spectrograms. "matplotlib" draw a figure with specgram, "numpy" compute '
+                         'the STFT and write the PNG directly')
+parser.add_argument('--spectrogram_tensors', action='store_true',
+                    help='If set, the log power spectrograms (dB, samples scaled to [-1, 1]) are also written as raw '
+                         'arrays in shards in {output_folder}/{output_version_nb}/preprocessed/{set_type}. '
+                         'See utils/spectrogram_shards.py')
+parser.add_argument('--spectrogram_tensor_dtype', default='float16', type=str, choices=spectrogram_tensor_dtypes,
+                    help='Data type of the spectrogram tensors')
+parser.add_argument('--spectrogram_tensor_min_db', default=-200, type=float,
+                    help='Floor of the spectrogram tensors values in dB')
+parser.add_argument('--spectrogram_scenes_per_shard', default=1000, type=int,
+                    help='Number of scenes in each spectrogram tensors shard')
 
 # Outputs
 parser.add_argument('--output_folder', default='../output', type=str,
@@ -98,6 +144,8 @@ parser.add_argument('--random_nb_generator_seed', default=None, type=int,
                     help='Set the random number generator seed to reproduce results')
 parser.add_argument('--nb_process', default=4, type=int,
                     help='Number of process allocated for the production')
+parser.add_argument('--chunk_size', default=10, type=int,
+                    help='Number of scenes assigned to a process at once')
 
 """
     Produce audio recording from scene JSON definition
@@ -131,7 +179,10 @@ class AudioSceneProducer:
                  setType,
                  outputPrefix,
                  outputFrameRate,
-                 randomSeed):
+                 randomSeed,
+                 packedSoundBankFilepath=None,
+                 backgroundNoiseBankSettings=None,
+                 produce_spectrogram_tensors=False):
 
         # Paths
         self.outputFolder = outputFolder
@@ -143,6 +194,7 @@ class AudioSceneProducer:
 
         self.produce_audio_files = produce_audio_files
         self.produce_spectrograms = produce_spectrograms
+        self.produce_spectrogram_tensors = produce_spectrogram_tensors
 
         experiment_output_folder = os.path.join(self.outputFolder, self.version_nb)
 
@@ -153,12 +205,14 @@ class AudioSceneProducer:
         # Loading scenes definition
         sceneFilename = '%s_%s_scenes.json' % (self.outputPrefix, self.setType)
         sceneFilepath = os.path.join(experiment_output_folder, 'scenes', sceneFilename)
-        with open(sceneFilepath) as scenesJson:
-            self.scenes = json.load(scenesJson)['scenes']
+        self.scenes, _ = load_scene_file(sceneFilepath)
 
         self.spectrogramSettings = spectrogramSettings
+        self.spectrogramColormapLut = None
         self.withBackgroundNoise = withBackgroundNoise
         self.backgroundNoiseGainSetting = backgroundNoiseGainSetting
+        self.backgroundNoiseBankSettings = backgroundNoiseBankSettings
+        self.backgroundNoiseBank = None
         self.withReverb = withReverb
         self.reverbSettings = reverbSettings
         self.outputFrameRate = outputFrameRate
@@ -206,9 +260,46 @@ class AudioSceneProducer:
         self.show_status_every = self.show_status_every if self.show_status_every > 0 else 1
 
         self.loadedSounds = []
+        self.loadedSoundIndexByName = {}
         self.randomSeed = randomSeed
 
+        self.packedSoundBankFilepath = packedSoundBankFilepath
+        self.soundBank = None
+
+        # Format of the loaded sounds. The scenes are assembled at this frame rate and sample width
+        self.soundsFrameRate = None
+        self.soundsSampleWidth = None
+
+        # Impulse responses of the convolution reverberation and reverberated sounds. Filled by each process
+        self.impulseResponseBank = None
+        self.reverberatedSoundCache = None
+
+    def loadPackedSoundBank(self):
+        print("Loading packed elementary sounds bank")
+        self.soundBank = Packed_Sound_Bank(self.packedSoundBankFilepath)
+
+        # Without resampling, the sounds are used at their native frame rate
+        self.soundsFrameRate = self.outputFrameRate if self.outputFrameRate else self.soundBank.native_frame_rate
+        self.soundsSampleWidth = self.soundBank.sample_width
+
+        if self.soundsFrameRate not in self.soundBank.frame_rates:
+            print("[ERROR] The packed sound bank '%s' doesn't contain sounds at %s Hz. Available frame rates : %s" %
+                  (self.packedSoundBankFilepath, self.soundsFrameRate, self.soundBank.frame_rates), file=sys.stderr)
+            exit(1)
+
+        missingSounds = [sound['filename'] for sound in self.elementarySounds if sound['filename'] not in self.soundBank]
+        if len(missingSounds) > 0:
+            print("[ERROR] %d elementary sounds are missing from the packed sound bank '%s'. The bank must be rebuilt" %
+                  (len(missingSounds), self.packedSoundBankFilepath), file=sys.stderr)
+            exit(1)
+
+        print("Done loading packed elementary sounds bank")
+
     def loadAllElementarySounds(self):
+        if self.packedSoundBankFilepath:
+            self.loadPackedSoundBank()
+            return
+
         print("Loading elementary sounds")
         for sound in self.elementarySounds:
             # Creating the audio segment (Suppose WAV format)
@@ -218,44 +309,111 @@ class AudioSceneProducer:
             if self.outputFrameRate and soundAudioSegment.frame_rate != self.outputFrameRate:
                 soundAudioSegment = soundAudioSegment.set_frame_rate(self.outputFrameRate)
 
+            self.loadedSoundIndexByName[sound['filename']] = len(self.loadedSounds)
             self.loadedSounds.append({
                 'name': sound['filename'],
-                'audioSegment': soundAudioSegment
+                'samples': np.frombuffer(soundAudioSegment.raw_data,
+                                         dtype=get_sample_dtype(soundAudioSegment.sample_width)),
+                'frameRate': soundAudioSegment.frame_rate,
+                'sampleWidth': soundAudioSegment.sample_width
             })
 
+        # The scenes are assembled by copying the samples, all the sounds must share the same format
+        frameRates = set(sound['frameRate'] for sound in self.loadedSounds)
+        sampleWidths = set(sound['sampleWidth'] for sound in self.loadedSounds)
+        if len(frameRates) > 1 or len(sampleWidths) > 1:
+            print("[ERROR] The elementary sounds must have the same frame rate and sample width. "
+                  "Use --do_resample to resample them", file=sys.stderr)
+            exit(1)
+
+        self.soundsFrameRate = frameRates.pop()
+        self.soundsSampleWidth = sampleWidths.pop()
+
         print("Done loading elementary sounds")
 
-    def _getLoadedAudioSegmentByName(self, name):
-        filterResult = list(filter(lambda sound: sound['name'] == name, self.loadedSounds))
-        if len(filterResult) == 1:
-            return filterResult[0]['audioSegment']
+    def loadBackgroundNoiseBank(self):
+        """
+        Generate the background noise buffers. Must be called after loading the sounds (Noise at their frame rate)
+        Called once before starting the workers so that the buffers are shared
+        """
+        if not self.withBackgroundNoise or not self.backgroundNoiseBankSettings or \
+           self.backgroundNoiseBankSettings['nbBuffers'] <= 0:
+            return
+
+        print("Generating background noise bank")
+        bufferLength = int(self.backgroundNoiseBankSettings['duration'] * self.soundsFrameRate)
+        self.backgroundNoiseBank = Background_Noise_Bank(self.backgroundNoiseBankSettings['nbBuffers'], bufferLength,
+                                                         get_derived_seed(self.randomSeed, 'background_noise'))
+
+    def addBackgroundNoise(self, sceneSamples, gain):
+        if self.backgroundNoiseBank is not None:
+            self.backgroundNoiseBank.overlay(sceneSamples, gain)
         else:
-            print('[ERROR] Could not retrieve loaded audio segment \'' + name + '\' from memory.')
-            exit(1)
+            AudioSceneProducer.overlayBackgroundNoise(sceneSamples, gain)
 
-    def produceSceneProcess(self, queue, emptyQueueTimeout=5):
-        # Wait 1 sec for the main thread to fillup the queue
-        time.sleep(1)
+    def getImpulseResponseBank(self):
+        if self.impulseResponseBank is None:
+            self.impulseResponseBank = Impulse_Response_Bank(self.soundsFrameRate,
+                                                             self.reverbSettings.get('impulseResponseCacheSize', 32))
 
-        emptyQueueCount = 0
-        while emptyQueueCount < emptyQueueTimeout:
-            if not queue.empty():
-                # Reset empty queue count
-                emptyQueueCount = 0
+        return self.impulseResponseBank
 
-                # Retrieve Id and produce scene
-                idToProcess = queue.get()
-                self.produceScene(idToProcess)
-            else:
-                emptyQueueCount += 1
-                time.sleep(random.random())
+    def getReverberatedSoundCache(self):
+        if self.reverberatedSoundCache is None:
+            cacheSize = self.reverbSettings.get('soundCacheSize', 512)
+            self.reverberatedSoundCache = Reverberated_Sound_Cache(self.getImpulseResponseBank(),
+                                                                   cacheSize * 1024 * 1024)
+
+        return self.reverberatedSoundCache
+
+    def getReverberatedSoundCacheStats(self):
+        """
+        Number of hits and misses of the reverberated sounds cache of this process
+        """
+        if self.reverberatedSoundCache is None:
+            return 0, 0
 
-        return
+        return self.reverberatedSoundCache.nb_hits, self.reverberatedSoundCache.nb_misses
 
+    def _getLoadedSamplesByName(self, name):
+        if self.soundBank is not None:
+            return self.soundBank.get_pcm_samples(name, self.soundsFrameRate)
+
+        soundIndex = self.loadedSoundIndexByName.get(name)
+        if soundIndex is not None:
+            return self.loadedSounds[soundIndex]['samples']
+        else:
+            print('[ERROR] Could not retrieve loaded sound \'' + name + '\' from memory.')
+            exit(1)
+
+    def _getLoadedSamples(self, sounds):
+        """
+        Retrieve the samples of all the objects of a scene
+        The sounds are loaded in the order of the elementary sounds definition, the sound id is the position of the
+        sound in self.loadedSounds. The filename is used if the id doesn't match (Different definition file)
+        """
+        if self.soundBank is not None:
+            return [self.soundBank.get_pcm_samples(sound['filename'], self.soundsFrameRate) for sound in sounds]
+
+        soundsSamples = []
+        for sound in sounds:
+            soundId = sound.get('id')
+            if soundId is not None and soundId < len(self.loadedSounds) and \
+               self.loadedSounds[soundId]['name'] == sound['filename']:
+                soundsSamples.append(self.loadedSounds[soundId]['samples'])
+            else:
+                soundsSamples.append(self._getLoadedSamplesByName(sound['filename']))
+
+        return soundsSamples
 
     def produceScene(self, sceneId):
-        # Since this function is run by different process, we must set the same seed for every process
-        init_random_seed(self.randomSeed)
+        """
+        Produce the audio file and/or the spectrogram image of a scene
+        Return the spectrogram tensor of the scene when producing the spectrogram tensors (Written by the main process)
+        """
+        # Each scene has its own seed derived from the global seed, the set and the scene index.
+        # A scene is rendered identically no matter which process produce it or which scenes are produced with it
+        init_random_seed(get_derived_seed(self.randomSeed, self.setType, sceneId))
 
         if sceneId < self.nbOfLoadedScenes:
 
@@ -263,82 +421,207 @@ class AudioSceneProducer:
             if sceneId % self.show_status_every == 0:
                 print('Producing scene ' + str(sceneId), flush=True)
 
-            sceneAudioSegment = self.assembleAudioScene(scene)
-
-            if self.outputFrameRate and sceneAudioSegment.frame_rate != self.outputFrameRate:
-                sceneAudioSegment = sceneAudioSegment.set_frame_rate(self.outputFrameRate)
+            # The sounds are already at the output frame rate (Resampled when loaded or packed)
+            sceneSamples = self.assembleAudioScene(scene)
 
             if self.produce_audio_files:
                 audioFilename = '%s_%s_%06d.flac' % (self.outputPrefix, self.setType, sceneId)
+                sceneAudioSegment = int_samples_to_pydub_audiosegment(sceneSamples, self.soundsFrameRate,
+                                                                      self.soundsSampleWidth)
                 sceneAudioSegment.export(os.path.join(self.audio_output_folder, audioFilename), format='flac')
 
-            if self.produce_spectrograms:
-                spectrogram = AudioSceneProducer.createSpectrogram(sceneAudioSegment,
-                                                                   self.spectrogramSettings['freqResolution'],
-                                                                   self.spectrogramSettings['timeResolution'],
-                                                                   self.spectrogramSettings['window_length'],
-                                                                   self.spectrogramSettings['window_overlap'])
+            # The numpy spectrogram is computed once for the image and the tensor
+            numpyImage = self.produce_spectrograms and self.spectrogramSettings.get('backend', 'matplotlib') == 'numpy'
+            spectrogramDb = None
+            if numpyImage or self.produce_spectrogram_tensors:
+                spectrogramDb = self.computeSpectrogram(sceneSamples)
 
+            if self.produce_spectrograms:
                 imageFilename = '%s_%s_%06d.png' % (self.outputPrefix, self.setType, sceneId)
-                spectrogram.savefig(os.path.join(self.images_output_folder, imageFilename), dpi=100)
+                imageFilepath = os.path.join(self.images_output_folder, imageFilename)
 
-                AudioSceneProducer.clearSpectrogram(spectrogram)
+                if numpyImage:
+                    self.writeSpectrogramImage(spectrogramDb, len(sceneSamples), imageFilepath)
+                else:
+                    spectrogram = AudioSceneProducer.createSpectrogram(sceneSamples,
+                                                                       self.soundsFrameRate,
+                                                                       self.spectrogramSettings['freqResolution'],
+                                                                       self.spectrogramSettings['timeResolution'],
+                                                                       self.spectrogramSettings['window_length'],
+                                                                       self.spectrogramSettings['window_overlap'])
+
+                    spectrogram.savefig(imageFilepath, dpi=100)
+
+                    AudioSceneProducer.clearSpectrogram(spectrogram)
+
+            if self.produce_spectrogram_tensors:
+                return self.createSpectrogramTensor(spectrogramDb)
 
         else:
             print("[ERROR] The scene specified by id '%d' couln't be found" % sceneId)
 
-    def assembleAudioScene(self, scene):
-        sceneAudioSegment = AudioSegment.empty()
+        return None
+
+    def computeSpectrogram(self, sceneSamples):
+        """
+        Log power spectrogram (nb_freqs, nb_frames) of the samples scaled to [-1, 1]. Independent of the sample width
+        """
+        floatArray = int_samples_to_float_array(sceneSamples, sceneSamples.dtype.itemsize)
+
+        return compute_spectrogram(floatArray, self.soundsFrameRate,
+                                   self.spectrogramSettings['window_length'],
+                                   self.spectrogramSettings['window_overlap'])
+
+    def createSpectrogramTensor(self, spectrogramDb):
+        """
+        Spectrogram floored at the minimum dB (Digital silence is -inf) in the tensor dtype
+        """
+        spectrogram = np.maximum(spectrogramDb, self.spectrogramSettings.get('tensorMinDb', -200))
+
+        return spectrogram.astype(self.spectrogramSettings.get('tensorDtype', 'float16'))
 
-        sceneAudioSegment += AudioSegment.silent(duration=scene['silence_before'])
-        for sound in scene['objects']:
-            newAudioSegment = self._getLoadedAudioSegmentByName(sound['filename'])
+    @staticmethod
+    def getNbSamples(duration, frameRate):
+        """
+        Number of samples in {duration} ms
+        """
+        return int(frameRate * duration / 1000)
 
-            sceneAudioSegment += newAudioSegment
+    def assembleAudioScene(self, scene):
+        """
+        Assemble the scene in one preallocated sample array
+        The length of the scene is computed from the silences and the sounds length, each sound is then copied at
+        its offset. Silences are converted to a number of samples at the frame rate of the sounds
+        """
+        soundsSamples = self._getLoadedSamples(scene['objects'])
+
+        silenceBefore = AudioSceneProducer.getNbSamples(scene['silence_before'], self.soundsFrameRate)
+        silencesAfter = [AudioSceneProducer.getNbSamples(sound['silence_after'], self.soundsFrameRate)
+                         for sound in scene['objects']]
+
+        sceneLength = silenceBefore + sum(len(samples) for samples in soundsSamples) + sum(silencesAfter)
+        sceneSamples = np.zeros(sceneLength, dtype=get_sample_dtype(self.soundsSampleWidth))
+
+        soundsOnsets = []
+        offset = silenceBefore
+        for samples, silenceAfter in zip(soundsSamples, silencesAfter):
+            sceneSamples[offset:offset + len(samples)] = samples
+            soundsOnsets.append(offset)
 
             # Insert a silence padding after the sound
-            sceneAudioSegment += AudioSegment.silent(duration=sound['silence_after'])
+            offset += len(samples) + silenceAfter
+
+        # When reverberating each sound, the noise is added after the reverberation
+        reverbPerSound = self.withReverb and self.reverbSettings.get('perSound', False)
 
         if self.withBackgroundNoise:
             gain = random.randrange(self.backgroundNoiseGainSetting['min'], self.backgroundNoiseGainSetting['max'])
-            sceneAudioSegment = AudioSceneProducer.overlayBackgroundNoise(sceneAudioSegment, gain)
+            if not reverbPerSound:
+                self.addBackgroundNoise(sceneSamples, gain)
 
         if self.withReverb:
             roomScale = random.randrange(self.reverbSettings['roomScale']['min'],
                                          self.reverbSettings['roomScale']['max'])
             delay = random.randrange(self.reverbSettings['delay']['min'], self.reverbSettings['delay']['max'])
-            sceneAudioSegment = AudioSceneProducer.applyReverberation(sceneAudioSegment, roomScale, delay)
 
-        # Make sure the everything is in Mono (If stereo, will convert to mono)
-        sceneAudioSegment.set_channels(1)
+            if reverbPerSound:
+                # The reverberated sounds are cached by room scale. Few distinct room scales are needed to reuse them
+                roomScale -= (roomScale - self.reverbSettings['roomScale']['min']) % \
+                             self.reverbSettings.get('roomScaleStep', 1)
+
+                sceneSamples = self.applyReverberationPerSound(sceneSamples, scene['objects'], soundsSamples,
+                                                               soundsOnsets, roomScale, delay)
+            else:
+                backend = self.reverbSettings.get('backend', 'sox')
+                impulseResponses = self.getImpulseResponseBank() if backend == 'convolution' else None
+                sceneSamples = AudioSceneProducer.applyReverberation(sceneSamples, roomScale, delay, backend,
+                                                                     self.soundsFrameRate, impulseResponses)
+
+            if self.withBackgroundNoise and reverbPerSound:
+                self.addBackgroundNoise(sceneSamples, gain)
+
+        return sceneSamples
+
+    def applyReverberationPerSound(self, sceneSamples, sounds, soundsSamples, soundsOnsets, roomScale, delay):
+        """
+        Mix the cached reverberation of each sound at its onset (Same result as the convolution backend without noise)
+        """
+        sampleWidth = sceneSamples.dtype.itemsize
+        floatArray = int_samples_to_float_array(sceneSamples, sampleWidth)
+
+        # The samples are only converted if the sound is not cached
+        sceneSounds = [(sound['filename'], partial(int_samples_to_float_array, samples, sampleWidth), onset)
+                       for sound, samples, onset in zip(sounds, soundsSamples, soundsOnsets)]
 
-        return sceneAudioSegment
+        floatArrayWithReverb = self.getReverberatedSoundCache().add_reverberation(floatArray, sceneSounds,
+                                                                                  roomScale, delay)
+
+        return float_array_to_int_samples(floatArrayWithReverb, sampleWidth)
+
+    @staticmethod
+    def applyReverberation(sceneSamples, roomScale, delay, backend='sox', frameRate=44100, impulseResponses=None):
+        """
+        The sox backend receive the samples without their frame rate (pysndfx assume 44100 Hz)
+        The numpy and convolution backends scale the delays to {frameRate}
+        The convolution backend use the impulse responses of {impulseResponses} (Impulse_Response_Bank)
+        """
+        sampleWidth = sceneSamples.dtype.itemsize
+        floatArray = int_samples_to_float_array(sceneSamples, sampleWidth)
+
+        if backend == 'convolution':
+            floatArrayWithReverb = impulseResponses.add_reverberation(floatArray, room_scale=roomScale, pre_delay=delay)
+        elif backend == 'numpy':
+            floatArrayWithReverb = add_reverberation_numpy(floatArray, frame_rate=frameRate, room_scale=roomScale,
+                                                           pre_delay=delay)
+        else:
+            floatArrayWithReverb = add_reverberation(floatArray, room_scale=roomScale, pre_delay=delay)
+
+        return float_array_to_int_samples(floatArrayWithReverb, sampleWidth)
 
     @staticmethod
-    def applyReverberation(audioSegment, roomScale, delay):
-        floatArray = pydub_audiosegment_to_float_array(audioSegment, audioSegment.frame_rate, audioSegment.sample_width)
+    def overlayBackgroundNoise(sceneSamples, noiseGain):
+        """
+        Add a white noise to the scene (In place). The sum is clipped to the range of the sample type
+        """
+        backgroundNoise = generate_random_noise_samples(len(sceneSamples), noiseGain, sceneSamples.dtype.itemsize)
 
-        floatArrayWithReverb = add_reverberation(floatArray, room_scale=roomScale, pre_delay=delay)
+        sampleTypeInfo = np.iinfo(sceneSamples.dtype)
+        mixedSamples = sceneSamples.astype(np.int64)
+        mixedSamples += backgroundNoise
+        np.clip(mixedSamples, sampleTypeInfo.min, sampleTypeInfo.max, out=mixedSamples)
 
-        return float_array_to_pydub_audiosegment(floatArrayWithReverb, audioSegment.frame_rate,
-                                                 audioSegment.sample_width)
+        sceneSamples[:] = mixedSamples
 
     @staticmethod
-    def overlayBackgroundNoise(sceneAudioSegment, noiseGain):
-        backgroundNoise = generate_random_noise(sceneAudioSegment.duration_seconds * 1000,
-                                                noiseGain,
-                                                sceneAudioSegment.frame_width,
-                                                sceneAudioSegment.frame_rate)
+    def getSpectrogramSize(nbSamples, frameRate, freqResolution, timeResolution):
+        """
+        Size in pixels of the spectrogram image (Width, Height)
+        """
+        highestFreq = frameRate/2
+        height = highestFreq // freqResolution
+        width = nbSamples / frameRate * 1000 // timeResolution
+
+        return int(width), int(height)
 
-        sceneAudioSegment = backgroundNoise.overlay(sceneAudioSegment)
+    def writeSpectrogramImage(self, spectrogramDb, nbSamples, imageFilepath):
+        """
+        Write the numpy spectrogram as a PNG (Same image size and colors as createSpectrogram)
+        The colors are normalized by the range of the spectrogram, the scale of the samples doesn't change the image
+        """
+        width, height = AudioSceneProducer.getSpectrogramSize(nbSamples, self.soundsFrameRate,
+                                                              self.spectrogramSettings['freqResolution'],
+                                                              self.spectrogramSettings['timeResolution'])
 
-        return sceneAudioSegment
+        if self.spectrogramColormapLut is None:
+            self.spectrogramColormapLut = get_colormap_lut(matplotlib.rcParams['image.cmap'])
+
+        write_png(imageFilepath, spectrogram_to_image(spectrogramDb, width, height, self.spectrogramColormapLut))
 
     @staticmethod
-    def createSpectrogram(sceneAudioSegment, freqResolution, timeResolution, windowLength, windowOverlap):
-        highestFreq = sceneAudioSegment.frame_rate/2
+    def createSpectrogram(sceneSamples, frameRate, freqResolution, timeResolution, windowLength, windowOverlap):
+        highestFreq = frameRate/2
         height = highestFreq // freqResolution
-        width = sceneAudioSegment.duration_seconds * 1000 // timeResolution
+        width = len(sceneSamples) / frameRate * 1000 // timeResolution
 
         # Set figure settings to remove all axis
         spectrogram = plt.figure(frameon=False)
@@ -349,9 +632,8 @@ class AudioSceneProducer:
 
         # Generate the spectrogram
         # See https://matplotlib.org/api/_as_gen/matplotlib.pyplot.specgram.html?highlight=matplotlib%20pyplot%20specgram#matplotlib.pyplot.specgram
-        Pxx, freqs, bins, im = ax.specgram(x=np.frombuffer(sceneAudioSegment._data,
-                                                            dtype=get_array_type(8*sceneAudioSegment.frame_width)),
-                                            Fs=sceneAudioSegment.frame_rate,
+        Pxx, freqs, bins, im = ax.specgram(x=sceneSamples,
+                                            Fs=frameRate,
                                             window=matplotlib.mlab.window_hanning,
                                             NFFT=windowLength,
                                             noverlap=windowOverlap,
@@ -367,6 +649,41 @@ class AudioSceneProducer:
         gc.collect()
 
 
+# Production workers
+_workerProducer = None
+
+# Under this hit rate, reverberating each sound is usually slower than reverberating the whole scene
+reverbCacheMinHitRate = 0.5
+
+
+def initProducerWorker(producer):
+    global _workerProducer
+    _workerProducer = producer
+
+
+def produceScenesChunk(sceneIds):
+    """
+    Produce a chunk of scenes in a worker process
+    A failing scene doesn't stop the chunk. Return the id and the traceback of the scenes that failed, the
+    spectrogram tensors of the produced scenes (Empty if not producing the tensors) and the number of hits and misses
+    of the reverberated sounds cache while producing the chunk
+    """
+    failures = []
+    tensors = {}
+    nbHits, nbMisses = _workerProducer.getReverberatedSoundCacheStats()
+    for sceneId in sceneIds:
+        try:
+            tensor = _workerProducer.produceScene(sceneId)
+            if tensor is not None:
+                tensors[sceneId] = tensor
+        except (Exception, SystemExit):
+            failures.append((sceneId, traceback.format_exc()))
+
+    chunkNbHits, chunkNbMisses = _workerProducer.getReverberatedSoundCacheStats()
+
+    return failures, tensors, (chunkNbHits - nbHits, chunkNbMisses - nbMisses)
+
+
 def mainPool():
     args = parser.parse_args()
 
@@ -374,8 +691,8 @@ def mainPool():
     assert args.random_nb_generator_seed is not None, "The seed must be specified in the arguments."
     init_random_seed(args.random_nb_generator_seed)
 
-    # If not producing audio, we will produce spectrograms
-    if args.no_audio_files and not args.produce_spectrograms:
+    # If not producing audio, we will produce spectrograms (Unless producing the spectrogram tensors)
+    if args.no_audio_files and not args.produce_spectrograms and not args.spectrogram_tensors:
         args.produce_spectrograms = True
 
     # Preparing settings
@@ -389,7 +706,12 @@ def mainPool():
         'delay': {
             'min': int(reverbDelayRange[0]),
             'max': int(reverbDelayRange[1])
-        }
+        },
+        'backend': args.reverb_backend,
+        'impulseResponseCacheSize': args.reverb_impulse_response_cache_size,
+        'perSound': args.reverb_per_sound,
+        'soundCacheSize': args.reverb_sound_cache_size,
+        'roomScaleStep': args.reverb_per_sound_room_scale_step
     }
 
     backgroundNoiseGainRange = args.background_noise_gain_range.split(',')
@@ -401,6 +723,10 @@ def mainPool():
     args.with_background_noise = args.with_background_noise and not args.no_background_noise
     args.with_reverb = args.with_reverb and not args.no_reverb
 
+    if args.with_reverb and args.reverb_per_sound and args.reverb_backend != 'convolution':
+        print("[ERROR] --reverb_per_sound require --reverb_backend convolution", file=sys.stderr)
+        exit(1)
+
     # Creating the producer
     producer = AudioSceneProducer(outputFolder=args.output_folder,
                                   version_nb=args.output_version_nb,
@@ -408,6 +734,12 @@ def mainPool():
                                   elementarySoundFolderPath=args.elementary_sounds_folder,
                                   setType=args.set_type,
                                   randomSeed=args.random_nb_generator_seed,
+                                  packedSoundBankFilepath=args.packed_sound_bank,
+                                  produce_spectrogram_tensors=args.spectrogram_tensors,
+                                  backgroundNoiseBankSettings={
+                                      'nbBuffers': args.background_noise_bank_size,
+                                      'duration': args.background_noise_bank_duration
+                                  },
                                   outputFrameRate=args.output_frame_rate if args.do_resample else None ,
                                   outputPrefix=args.output_filename_prefix,
                                   produce_audio_files=not args.no_audio_files,
@@ -422,6 +754,9 @@ def mainPool():
                                       'timeResolution': args.spectrogram_time_resolution,
                                       'window_length': args.spectrogram_window_length,
                                       'window_overlap': args.spectrogram_window_overlap,
+                                      'backend': args.spectrogram_backend,
+                                      'tensorDtype': args.spectrogram_tensor_dtype,
+                                      'tensorMinDb': args.spectrogram_tensor_min_db
                                   })
 
     # Save arguments
@@ -443,37 +778,84 @@ def mainPool():
         idList = range(bounds[0], bounds[1])
         nb_generated = bounds[1] - bounds[0]
 
-    idList = iter(idList)
-
     # Load and preprocess all elementary sounds into memory
     producer.loadAllElementarySounds()
+    producer.loadBackgroundNoiseBank()
 
     startTime = datetime.now()
 
-    id_queue = Queue(maxsize=1000)
-    worker_processes = [Process(target=producer.produceSceneProcess, args=(id_queue,)) for i in range(args.nb_process)]
-
-    for p in worker_processes:
-        p.start()
-
-    done = False
-    while not done:
-        if not id_queue.full():
-            try:
-                id_queue.put(next(idList))
-            except StopIteration:
-                # Reached the end of the iterator
-                done = True
-        else:
-            # Producing the scenes take quite some time.
-            # We wait for 30 seconds in order to reduce context switch between main process and worker processes
-            time.sleep(30)
-
-    print("Done filling worker processes queue")
-
-    # Wait for all processes to finish
-    for p in worker_processes:
-        p.join()
+    # The scenes are distributed in chunks of {chunk_size} scenes. At most {maxPendingChunks} chunks are submitted at
+    # once so that the workers always have work queued without submitting all the scenes upfront
+    chunks = [idList[i:i + args.chunk_size] for i in range(0, len(idList), args.chunk_size)]
+    maxPendingChunks = 2 * args.nb_process
+
+    # The spectrogram tensors are returned by the workers and written in scene order by the main process
+    tensorWriter = None
+    if args.spectrogram_tensors:
+        tensorWriter = Spectrogram_Shard_Writer(os.path.join(args.output_folder, args.output_version_nb, 'preprocessed',
+                                                             args.set_type),
+                                                args.output_filename_prefix, args.set_type, idList,
+                                                scenes_per_shard=args.spectrogram_scenes_per_shard,
+                                                dtype=args.spectrogram_tensor_dtype,
+                                                info={
+                                                    'frame_rate': producer.soundsFrameRate,
+                                                    'window_length': args.spectrogram_window_length,
+                                                    'window_overlap': args.spectrogram_window_overlap,
+                                                    'min_db': args.spectrogram_tensor_min_db
+                                                })
+
+    failures = []
+    reverbCacheStats = [0, 0]
+
+    def recordChunk(chunk, chunkFailures, tensors, chunkReverbCacheStats=(0, 0)):
+        failures.extend(chunkFailures)
+        reverbCacheStats[0] += chunkReverbCacheStats[0]
+        reverbCacheStats[1] += chunkReverbCacheStats[1]
+
+        if tensorWriter is not None:
+            for sceneId in chunk:
+                tensorWriter.add(sceneId, tensors.get(sceneId))
+
+    with ProcessPoolExecutor(max_workers=args.nb_process,
+                             initializer=initProducerWorker, initargs=(producer,)) as executor:
+        chunkIterator = iter(chunks)
+        pendingChunks = {}
+        poolBroken = False
+
+        while True:
+            while not poolBroken and len(pendingChunks) < maxPendingChunks:
+                chunk = next(chunkIterator, None)
+                if chunk is None:
+                    break
+
+                try:
+                    pendingChunks[executor.submit(produceScenesChunk, chunk)] = chunk
+                except BrokenProcessPool as error:
+                    recordChunk(chunk, [(sceneId, repr(error)) for sceneId in chunk], {})
+                    poolBroken = True
+
+            if len(pendingChunks) == 0:
+                break
+
+            doneFutures, _ = wait(pendingChunks.keys(), return_when=FIRST_COMPLETED)
+            for future in doneFutures:
+                chunk = pendingChunks.pop(future)
+                try:
+                    recordChunk(chunk, *future.result())
+                except BrokenProcessPool as error:
+                    # A worker died (Killed, out of memory, etc). The scenes of the chunk were not produced
+                    recordChunk(chunk, [(sceneId, repr(error)) for sceneId in chunk], {})
+                    poolBroken = True
+
+        if poolBroken:
+            # The chunks that were never submitted
+            for chunk in chunkIterator:
+                recordChunk(chunk, [(sceneId, 'Not produced, the process pool is broken') for sceneId in chunk], {})
+
+    if tensorWriter is not None:
+        tensorWriter.close()
+
+    nb_generated -= len(failures)
 
     print("Job Done !")
     print(f"Took {str(datetime.now() - startTime)}")
@@ -483,6 +865,30 @@ def mainPool():
     if not args.no_audio_files:
         print(">>> Produced %d audio files." % nb_generated)
 
+    if args.spectrogram_tensors:
+        print(">>> Produced %d spectrogram tensors." % nb_generated)
+
+    if args.with_reverb and args.reverb_per_sound:
+        nbHits, nbMisses = reverbCacheStats
+        hitRate = nbHits / max(nbHits + nbMisses, 1)
+        print(">>> Reverberated sounds cache : %d hits, %d misses (%.1f%% hit rate)" %
+              (nbHits, nbMisses, 100 * hitRate))
+
+        # Each miss reverberate a sound and a scene contain many sounds. The cache only pay off when most are reused
+        if nbHits + nbMisses > 0 and hitRate < reverbCacheMinHitRate:
+            print("[WARNING] The reverberated sounds cache hit rate is low, --reverb_per_sound is probably slower than "
+                  "--reverb_backend convolution. Increase --reverb_per_sound_room_scale_step or "
+                  "--reverb_sound_cache_size, or produce more scenes per run", file=sys.stderr)
+
+    if len(failures) > 0:
+        failures = sorted(failures, key=lambda failure: failure[0])
+        for sceneId, error in failures[:10]:
+            print("[ERROR] Scene %d failed :\n%s" % (sceneId, error), file=sys.stderr)
+
+        print("[ERROR] %d scenes failed : %s" % (len(failures), ','.join(str(sceneId) for sceneId, _ in failures)),
+              file=sys.stderr)
+        exit(1)
+
 
 if __name__ == '__main__':
     mainPool()
@@ -0,0 +1,130 @@
+# CLEAR Dataset
+# >> Reverberation Benchmark
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+"""
+This script measure the time taken to apply the reverberation to a scene with each reverberation backend
+(See --reverb_backend in produce_scenes_audio.py). The scenes are random signals of different durations, each backend
+process the same signals with the same room scales and pre delays.
+
+The sox backend is skipped if the sox executable is not available.
+The impulse responses of the convolution backend are kept between the repetitions. The first repetition include the
+impulse response synthesis (Reported as 'first_time'), the following ones measure the cached case.
+
+Should be launched from the root of the repository :
+    python -m scripts.benchmark_reverberation --durations 5 20 --output_file reverb_benchmark.json
+"""
+
+import json
+import time
+import shutil
+import argparse
+import platform
+
+import numpy as np
+
+from utils.audio_processing import add_reverberation, add_reverberation_numpy, reverb_backends
+from utils.impulse_responses import Impulse_Response_Bank
+
+'''
+Arguments definition
+'''
+parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+
+parser.add_argument('--backends', type=str, nargs='+', default=reverb_backends, choices=reverb_backends,
+                    help='Reverberation backends to benchmark')
+parser.add_argument('--durations', type=float, nargs='+', default=[5, 10, 20],
+                    help='Duration of the scenes in seconds')
+parser.add_argument('--frame_rate', type=int, default=44100,
+                    help='Frame rate of the scenes. The sox backend always assume 44100 Hz')
+parser.add_argument('--room_scales', type=int, nargs='+', default=[10, 50, 100],
+                    help='Room scales to benchmark')
+parser.add_argument('--pre_delay', type=int, default=100,
+                    help='Pre delay in ms')
+parser.add_argument('--nb_repeat', type=int, default=5,
+                    help='Number of time each configuration is processed. The best time is kept')
+parser.add_argument('--random_seed', type=int, default=1,
+                    help='Random seed used to generate the signals')
+parser.add_argument('--output_file', type=str, default=None,
+                    help='Path of the JSON file where the results are written. Printed to stdout if not specified')
+
+
+def apply_reverberation(backend, signal, frame_rate, room_scale, pre_delay, impulse_responses):
+    if backend == 'convolution':
+        return impulse_responses.add_reverberation(signal, room_scale=room_scale, pre_delay=pre_delay)
+    elif backend == 'numpy':
+        return add_reverberation_numpy(signal, frame_rate=frame_rate, room_scale=room_scale, pre_delay=pre_delay)
+
+    return add_reverberation(signal, room_scale=room_scale, pre_delay=pre_delay)
+
+
+def main(args):
+    backends = list(args.backends)
+    if 'sox' in backends and shutil.which('sox') is None:
+        print("Skipping the sox backend. The sox executable was not found")
+        backends.remove('sox')
+
+    rng = np.random.RandomState(args.random_seed)
+    impulse_responses = Impulse_Response_Bank(args.frame_rate)
+
+    results = []
+    for duration in args.durations:
+        # White noise with an amplitude similar to the scenes
+        signal = (rng.rand(int(duration * args.frame_rate)) * 2 - 1) * 0.25
+
+        for room_scale in args.room_scales:
+            outputs = {}
+            for backend in backends:
+                times = []
+                for _ in range(args.nb_repeat):
+                    start = time.time()
+                    outputs[backend] = apply_reverberation(backend, signal, args.frame_rate, room_scale,
+                                                           args.pre_delay, impulse_responses)
+                    times.append(time.time() - start)
+
+                print("%-11s | %5.1f sec | room scale %3d | %.3f sec (x%.0f realtime)" % (
+                      backend, duration, room_scale, min(times), duration / max(min(times), 1e-6)))
+
+                results.append({
+                    'backend': backend,
+                    'duration': duration,
+                    'room_scale': room_scale,
+                    'pre_delay': args.pre_delay,
+                    'first_time': times[0],
+                    'best_time': min(times),
+                    'mean_time': sum(times) / len(times),
+                    'realtime_factor': duration / max(min(times), 1e-6)
+                })
+
+            # Difference with the numpy backend
+            for backend, output in outputs.items():
+                if backend != 'numpy' and 'numpy' in outputs:
+                    output = np.asarray(output).reshape(-1)[:len(signal)]
+                    difference = np.abs(output - outputs['numpy'][:len(output)]).max()
+                    print("       max difference between %s and numpy : %.5f" % (backend, difference))
+
+    report = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python_version': platform.python_version(),
+        'numpy_version': np.__version__,
+        'platform': platform.platform(),
+        'frame_rate': args.frame_rate,
+        'runs': results
+    }
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Results written to '%s'" % args.output_file)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
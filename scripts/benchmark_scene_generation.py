@@ -0,0 +1,272 @@
+# CLEAR Dataset
+# >> Scene Generation Benchmark
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+"""
+This script measure the throughput of the scene generation for different configurations.
+Starting from the scene generation presets in arguments/, it sweep :
+  - The scene length (Number of objects per scene)
+  - The constraints strictness
+  - The size of the elementary sounds bank (The sounds are subsampled or repeated)
+  - The sampling method
+
+Each configuration run in its own process. The scenes/sec, candidates/sec, acceptance rate, rejection counters and
+peak memory of each run are written to a JSON file so results can be compared across releases.
+
+Should be launched from the root of the repository :
+    python -m scripts.benchmark_scene_generation --output_file benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from itertools import product
+from multiprocessing import Pool, TimeoutError
+
+import numpy as np
+
+from generate_scenes_definition import Scene_generator, parser as scene_generation_parser
+from utils.misc import init_random_seed
+
+'''
+Arguments definition
+'''
+parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+
+parser.add_argument('--presets', type=str, nargs='+',
+                    default=['arguments/base_scene_generation.args',
+                             'arguments/multi_gen_variable/base_scene_generation_fixed.args',
+                             'arguments/multi_gen_variable/base_scene_generation_fixed_cogent_train.args'],
+                    help='Scene generation arguments files used as base configuration. Presets referencing a missing '
+                         'elementary sounds definition are skipped')
+parser.add_argument('--scene_lengths', type=str, nargs='*', default=[],
+                    help='Scene lengths to sweep, written as MIN,MAX (Ex : 5,15 10,10). '
+                         'If not specified, the scene length of the preset is used')
+parser.add_argument('--constraint_levels', type=str, nargs='+', default=['preset'],
+                    help='Constraints strictness to sweep. "preset" use the constraints of the preset. '
+                         'Available levels : %s' % ', '.join(['preset', 'none', 'loose', 'strict']))
+parser.add_argument('--bank_sizes', type=int, nargs='*', default=[],
+                    help='Number of elementary sounds to sweep. The sounds of the preset are subsampled or repeated '
+                         '(with new ids) to reach the requested size. If not specified, the whole bank is used')
+parser.add_argument('--sampling_methods', type=str, nargs='+', default=['rejection'],
+                    choices=['rejection', 'batched', 'constructive'],
+                    help='Sampling methods to sweep')
+parser.add_argument('--nb_scene', type=int, default=2000,
+                    help='Number of scenes to generate for each configuration')
+parser.add_argument('--random_seed', type=int, default=None,
+                    help='Random seed. Default to the seed of the preset')
+parser.add_argument('--trace_memory', action='store_true',
+                    help='If set, the peak memory allocated during the generation is also measured with tracemalloc. '
+                         'Tracing slow down the generation, the throughput should not be compared with untraced runs')
+parser.add_argument('--run_timeout', type=int, default=600,
+                    help='Maximum duration of a run in seconds. Some configurations can be impossible to satisfy '
+                         '(Ex : Not enough families in a small bank)')
+parser.add_argument('--output_file', type=str, default=None,
+                    help='Path of the JSON file where the results are written. Printed to stdout if not specified')
+
+# Constraints for each strictness level
+#   (min_nb_families, min_objects_per_family, min_nb_families_subject_to_min_objects_per_family,
+#    min_ratio_for_attribute)
+constraint_levels = {
+    'none': (0, 0, 0, 0.0),
+    'loose': (2, 2, 1, 0.1),
+    'strict': (4, 2, 3, 0.2)
+}
+
+
+def create_bank_definition(preset_args, bank_size, tmp_folder):
+    """
+    Write an elementary sounds definition containing {bank_size} sounds sampled from the definition of the preset
+    The sounds are picked at regular intervals so that all the families stay represented and are repeated if
+    {bank_size} is bigger than the bank. Return the absolute path of the definition
+    """
+    with open(os.path.join(preset_args.elementary_sounds_folder,
+                           preset_args.elementary_sounds_definition_filename), 'r') as f:
+        definition = json.load(f)
+
+    bank_definition = [dict(definition[i * len(definition) // bank_size]) for i in range(bank_size)]
+
+    bank_definition_filepath = os.path.abspath(os.path.join(tmp_folder, 'elementary_sounds_%d.json' % bank_size))
+    with open(bank_definition_filepath, 'w') as f:
+        json.dump(bank_definition, f)
+
+    return bank_definition_filepath
+
+
+def get_peak_rss():
+    """
+    Peak resident memory of the current process in bytes
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def run_benchmark(config):
+    """
+    Generate {config['nb_scene']} scenes and return the throughput and memory usage
+    Run in a separate process so the peak memory of each configuration is measured independently
+    """
+    setup_start = time.time()
+    init_random_seed(config['random_seed'])
+
+    scene_generator = Scene_generator(config['min_scene_length'],
+                                      config['max_scene_length'],
+                                      config['silence_padding_per_object'],
+                                      config['elementary_sounds_folder'],
+                                      config['elementary_sounds_definition_filename'],
+                                      config['metadata_file'],
+                                      'benchmark',
+                                      *config['constraints'],
+                                      sampling_method=config['sampling_method'],
+                                      progress_every=sys.maxsize)
+    setup_time = time.time() - setup_start
+
+    if config['trace_memory']:
+        tracemalloc.start()
+
+    generation_start = time.time()
+
+    scene_generator.generate(config['nb_scene'], random_seed=config['random_seed'])
+
+    generation_time = time.time() - generation_start
+
+    peak_traced_memory = None
+    if config['trace_memory']:
+        _, peak_traced_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    stats = scene_generator.get_stats_summary()
+
+    return {
+        'scenes_per_sec': config['nb_scene'] / max(generation_time, 1e-6),
+        'candidates_per_sec': stats['nbCandidates'] / max(generation_time, 1e-6),
+        'acceptance_rate': stats['acceptance_rate'],
+        'generation_time': generation_time,
+        'setup_time': setup_time,
+        'peak_traced_memory': peak_traced_memory,
+        'peak_rss': get_peak_rss(),
+        'stats': stats
+    }
+
+
+def create_configs(args, tmp_folder):
+    configs = []
+
+    for preset_filepath in args.presets:
+        preset_args = scene_generation_parser.parse_args(['@' + preset_filepath])
+
+        definition_filepath = os.path.join(preset_args.elementary_sounds_folder,
+                                           preset_args.elementary_sounds_definition_filename)
+        if not os.path.isfile(definition_filepath):
+            print("Skipping preset '%s'. Elementary sounds definition '%s' not found" % (preset_filepath,
+                                                                                       definition_filepath))
+            continue
+
+        if len(args.scene_lengths) > 0:
+            scene_lengths = [tuple(int(x) for x in scene_length.split(',')) for scene_length in args.scene_lengths]
+        else:
+            scene_lengths = [(preset_args.min_scene_length, preset_args.max_scene_length)]
+
+        bank_definitions = [(None, preset_args.elementary_sounds_definition_filename)]
+        if len(args.bank_sizes) > 0:
+            bank_definitions = [(bank_size, create_bank_definition(preset_args, bank_size, tmp_folder))
+                                for bank_size in args.bank_sizes]
+
+        for scene_length, constraint_level, bank_definition, sampling_method in product(scene_lengths,
+                                                                                        args.constraint_levels,
+                                                                                        bank_definitions,
+                                                                                        args.sampling_methods):
+            if constraint_level == 'preset':
+                constraints = (preset_args.constraint_min_nb_families,
+                               preset_args.constraint_min_object_per_family,
+                               preset_args.constraint_min_nb_families_subject_to_min_object_per_family,
+                               preset_args.constraint_min_ratio_for_attribute)
+            else:
+                constraints = constraint_levels[constraint_level]
+
+            bank_size, definition_filename = bank_definition
+
+            configs.append({
+                'preset': preset_filepath,
+                'min_scene_length': scene_length[0],
+                'max_scene_length': scene_length[1],
+                'constraint_level': constraint_level,
+                'constraints': constraints,
+                'bank_size': bank_size,
+                'sampling_method': sampling_method,
+                'nb_scene': args.nb_scene,
+                'trace_memory': args.trace_memory,
+                'random_seed': args.random_seed if args.random_seed is not None
+                                                 else preset_args.random_nb_generator_seed,
+                'silence_padding_per_object': preset_args.silence_padding_per_object,
+                'elementary_sounds_folder': preset_args.elementary_sounds_folder,
+                'elementary_sounds_definition_filename': definition_filename,
+                'metadata_file': preset_args.metadata_file
+            })
+
+    return configs
+
+
+def main(args):
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        configs = create_configs(args, tmp_folder)
+
+        for i, config in enumerate(configs):
+            print("[%d/%d] %s | length %d-%d | constraints %s | bank %s | %s sampling" % (
+                  i + 1, len(configs), config['preset'], config['min_scene_length'], config['max_scene_length'],
+                  config['constraint_level'], config['bank_size'] or 'preset', config['sampling_method']))
+
+            # New process for each run so that the memory measurements are independent
+            with Pool(1) as pool:
+                try:
+                    result = pool.apply_async(run_benchmark, (config,)).get(timeout=args.run_timeout)
+                except TimeoutError:
+                    result = {'timeout': args.run_timeout}
+
+            if 'timeout' in result:
+                print("   Timed out after %d sec" % args.run_timeout)
+            else:
+                print("   %.1f scenes/sec, %.1f candidates/sec, %.2f%% acceptance, %.1f MB peak" % (
+                      result['scenes_per_sec'], result['candidates_per_sec'], result['acceptance_rate'] * 100,
+                      result['peak_rss'] / 1e6))
+
+            run_config = {key: value for key, value in config.items() if key != 'elementary_sounds_definition_filename'}
+            results.append({
+                'config': run_config,
+                'results': result
+            })
+
+    report = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python_version': platform.python_version(),
+        'numpy_version': np.__version__,
+        'platform': platform.platform(),
+        'runs': results
+    }
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Results written to '%s'" % args.output_file)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
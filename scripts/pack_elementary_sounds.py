@@ -0,0 +1,75 @@
+# CLEAR Dataset
+# >> Elementary Sounds Packer
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+"""
+This script pack the elementary sounds in a single binary file that can be memory mapped by produce_scenes_audio.py
+(See --packed_sound_bank). The sounds are decoded and resampled once for each of the requested frame rates and the
+analysed attributes (loudness, brightness, duration) are stored along with the samples.
+
+Should be launched from the root of the repository :
+    python -m scripts.pack_elementary_sounds --frame_rates 48000 22050
+"""
+
+import os
+import argparse
+
+from pydub import AudioSegment
+
+from utils.elementary_sounds import Elementary_Sounds
+from utils.sound_bank import write_sound_bank, sample_formats
+
+'''
+Arguments definition
+'''
+parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+
+parser.add_argument('--elementary_sounds_folder', default='elementary_sounds', type=str,
+                    help='Folder containing all the elementary sounds and the JSON listing them')
+parser.add_argument('--elementary_sounds_definition_filename', default='elementary_sounds.json', type=str,
+                    help='Filename of the JSON file listing the attributes of the elementary sounds')
+parser.add_argument('--frame_rates', default=[], type=int, nargs='*',
+                    help='Frame rates stored in the bank. Should contain the --output_frame_rate used with '
+                         '--do_resample when producing the scenes. The native frame rate of the sounds is always stored')
+parser.add_argument('--sample_format', default='native', type=str, choices=sample_formats,
+                    help='Format of the stored samples. "native" keep the sample width of the WAV files (Produce the '
+                         'same audio as the WAV files), "int16" and "float32" convert the samples')
+parser.add_argument('--output_filepath', default=None, type=str,
+                    help='Path of the packed sound bank. '
+                         'Default to {elementary_sounds_folder}/{elementary_sounds_definition_filename}.pack')
+
+
+def main(args):
+    # Analysed attributes (Read from the analysis cache when available)
+    elementary_sounds = Elementary_Sounds(args.elementary_sounds_folder, args.elementary_sounds_definition_filename,
+                                          save_raw_values=True)
+
+    print("Loading elementary sounds audio")
+    sounds = []
+    native_frame_rates = set()
+    for definition in elementary_sounds.definition:
+        audio_segment = AudioSegment.from_wav(os.path.join(args.elementary_sounds_folder, definition['filename']))
+        native_frame_rates.add(audio_segment.frame_rate)
+        sounds.append((definition, audio_segment))
+
+    frame_rates = sorted(native_frame_rates.union(args.frame_rates))
+
+    output_filepath = args.output_filepath
+    if output_filepath is None:
+        output_filepath = os.path.join(args.elementary_sounds_folder,
+                                       os.path.splitext(args.elementary_sounds_definition_filename)[0] + '.pack')
+
+    print("Packing %d sounds at %s Hz" % (len(sounds), ', '.join(str(frame_rate) for frame_rate in frame_rates)))
+    write_sound_bank(output_filepath, sounds, frame_rates, args.sample_format)
+
+    print("Packed sound bank written to '%s' (%.1f MB)" % (output_filepath, os.path.getsize(output_filepath) / 1e6))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
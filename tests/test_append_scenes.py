@@ -0,0 +1,71 @@
+# CLEAR Dataset
+# >> Scene generation append tests
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from utils.scene_io import load_scene_file, get_scene_filepath
+
+"""
+    Run with : python -m unittest discover tests
+"""
+
+repository_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Test_Append_Scenes(unittest.TestCase):
+
+    def setUp(self):
+        self.output_folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.output_folder.cleanup()
+
+    def generate_scenes(self, *arguments):
+        return subprocess.run([sys.executable, 'generate_scenes_definition.py', '@arguments/base_scene_generation.args',
+                               '--output_folder', self.output_folder.name, '--output_version_nb', 'append_test',
+                               '--nb_scene', '20'] + list(arguments),
+                              cwd=repository_folder, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def load_scenes(self, set_type):
+        scenes_folder = os.path.join(self.output_folder.name, 'append_test', 'scenes')
+        scenes, _ = load_scene_file(get_scene_filepath(scenes_folder, 'CLEAR', set_type))
+
+        return scenes
+
+    def test_append_without_relationships(self):
+        result = self.generate_scenes('--no_relationships')
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        # The scene format of the existing files is used when the flag is not repeated
+        result = self.generate_scenes('--append')
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        scenes = [scene for set_type in ['train', 'val', 'test'] for scene in self.load_scenes(set_type)]
+        self.assertEqual(len(scenes), 40)
+        self.assertTrue(all('relationships' not in scene for scene in scenes))
+
+    def test_append_with_relationships(self):
+        result = self.generate_scenes()
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        result = self.generate_scenes('--append', '--no_relationships')
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        scenes = [scene for set_type in ['train', 'val', 'test'] for scene in self.load_scenes(set_type)]
+        self.assertEqual(len(scenes), 40)
+        self.assertTrue(all('relationships' in scene for scene in scenes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,12 +8,12 @@
 #               IGLU - CHIST-ERA
 
 from array import array
-from pydub import AudioSegment
 import numpy as np
+from scipy.signal import lfilter
 import pyloudnorm
 from pysndfx import AudioEffectsChain
-from pydub.utils import get_min_max_value, get_frame_width, get_array_type, db_to_float
-from utils.misc import pydub_audiosegment_to_float_array
+from pydub.utils import get_min_max_value, db_to_float
+from utils.misc import pydub_audiosegment_to_float_array, get_sample_dtype
 
 
 def get_perceptual_loudness(pydub_audio_segment):
@@ -26,23 +26,17 @@ def get_perceptual_loudness(pydub_audio_segment):
   return loudness_meter.integrated_loudness(sound_float_array)
 
 
-def generate_random_noise(duration, gain, frame_width, sample_rate):
-  bit_depth = 8 * frame_width
-  minval, maxval = get_min_max_value(bit_depth)
-  sample_width = get_frame_width(bit_depth)
-  array_type = get_array_type(bit_depth)
+def generate_random_noise_samples(sample_count, gain, sample_width):
+  """
+  Uniform white noise samples of {sample_width} bytes attenuated by {gain} dB
+  """
+  minval, maxval = get_min_max_value(8 * sample_width)
 
   gain = db_to_float(gain)
-  sample_count = int(sample_rate * (duration / 1000.0))
 
-  data = ((np.random.rand(sample_count, 1) * 2) - 1.0) * maxval * gain
+  data = ((np.random.rand(sample_count) * 2) - 1.0) * maxval * gain
 
-  return AudioSegment(data=data.astype(array_type).tobytes(), metadata={
-    "channels": 1,
-    "sample_width": sample_width,
-    "frame_rate": sample_rate,
-    "frame_width": sample_width,
-  })
+  return data.astype(get_sample_dtype(sample_width))
 
 
 def add_reverberation(sound,
@@ -65,3 +59,105 @@ def add_reverberation(sound,
   )
 
   return transformer(sound)
+
+
+"""
+    NumPy reverberation (Same algorithm as the sox reverb effect : Freeverb comb/allpass network)
+      - 8 parallel feedback comb filters with a one pole lowpass (hf damping) in the feedback loop
+      - 4 serial allpass filters
+      - The delay lengths are defined for 44100 Hz and scaled to the frame rate of the signal
+    Each filter is processed in blocks of its delay length. Inside a block, the output only depend on the previous
+    block so the filters are vectorized instead of iterating over every sample
+"""
+reverb_backends = ['sox', 'numpy', 'convolution']
+
+reverb_comb_lengths = [1116, 1188, 1277, 1356, 1422, 1491, 1557, 1617]
+reverb_allpass_lengths = [225, 341, 441, 556]
+
+
+def _split_blocks(signal, block_length):
+  nb_blocks = -(-len(signal) // block_length)
+  blocks = np.zeros(nb_blocks * block_length, dtype=np.float64)
+  blocks[:len(signal)] = signal
+
+  return blocks.reshape(nb_blocks, block_length)
+
+
+def _comb_filter(signal, delay, feedback, hf_damping):
+  """
+  out[n] = buf[n - delay], buf[n] = in[n] + feedback * lowpass(out)[n]
+  """
+  blocks = _split_blocks(signal, delay)
+  output = np.zeros_like(blocks)
+
+  lowpass_b = [1 - hf_damping]
+  lowpass_a = [1, -hf_damping]
+  lowpass_state = np.zeros(1)
+
+  delay_line = np.zeros(delay)
+  for i in range(len(blocks)):
+    output[i] = delay_line
+    stored, lowpass_state = lfilter(lowpass_b, lowpass_a, delay_line, zi=lowpass_state)
+    delay_line = blocks[i] + stored * feedback
+
+  return output.reshape(-1)[:len(signal)]
+
+
+def _allpass_filter(signal, delay):
+  """
+  out[n] = buf[n - delay] - in[n], buf[n] = in[n] + 0.5 * buf[n - delay]
+  """
+  blocks = _split_blocks(signal, delay)
+
+  # The delay line of each block only depend on the delay line of the previous block
+  delay_lines = lfilter([1], [1, -0.5], blocks, axis=0)
+
+  output = -blocks
+  output[1:] += delay_lines[:-1]
+
+  return output.reshape(-1)[:len(signal)]
+
+
+def add_reverberation_numpy(sound,
+                            frame_rate=44100,
+                            reverberance=100,
+                            hf_damping=50,
+                            room_scale=50,
+                            pre_delay=20,
+                            wet_gain=0,
+                            wet_only=False):
+  """
+  Same parameters as add_reverberation() (sox backend) for a mono float array.
+  The stereo depth has no effect on a mono signal and is not supported. The output has the same length as the input
+  and is clipped to [-1, 1[ like the float output of sox
+  """
+  # Parameters mapping of the sox reverb effect
+  scale = room_scale / 100 * 0.9 + 0.1
+  a = -1 / np.log(1 - 0.3)
+  b = 100 / (np.log(1 - 0.98) * a + 1)
+  feedback = 1 - np.exp((reverberance - b) / (a * b))
+  damping = hf_damping / 100 * 0.3 + 0.2
+  gain = db_to_float(wet_gain) * 0.015
+  rate_ratio = frame_rate / 44100
+
+  sound = np.asarray(sound, dtype=np.float64)
+
+  # The pre delay is only applied to the reverberated signal
+  pre_delay_length = min(int(frame_rate * pre_delay / 1000 + 0.5), len(sound))
+  delayed = np.zeros(len(sound))
+  delayed[pre_delay_length:] = sound[:len(sound) - pre_delay_length]
+
+  wet = np.zeros(len(sound))
+  for comb_length in reverb_comb_lengths:
+    delay = max(int(scale * rate_ratio * comb_length + 0.5), 1)
+    wet += _comb_filter(delayed, delay, feedback, damping)
+
+  for allpass_length in reverb_allpass_lengths:
+    delay = max(int(rate_ratio * allpass_length + 0.5), 1)
+    wet = _allpass_filter(wet, delay)
+
+  wet *= gain
+
+  output = wet if wet_only else sound + wet
+
+  return np.clip(output, -1, 1 - 2.0 ** -31, out=output)
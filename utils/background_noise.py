@@ -0,0 +1,56 @@
+# CLEAR Dataset
+# >> Background Noise Bank
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+import random
+
+import numpy as np
+from pydub.utils import get_min_max_value, db_to_float
+
+
+class Background_Noise_Bank:
+    """
+    Long uniform white noise buffers generated once from {random_seed}
+    The noise of a scene is a slice of one of the buffers starting at a random offset. The buffer and the offset are
+    drawn from the python random generator so they follow the seed of the scene
+    Buffers shorter than the scene are repeated
+    """
+
+    def __init__(self, nb_buffers, buffer_length, random_seed):
+        rng = np.random.RandomState(random_seed)
+
+        self.buffers = [(rng.rand(buffer_length).astype(np.float32) * 2) - 1 for _ in range(nb_buffers)]
+
+    def get_noise(self, sample_count):
+        """
+        Random slice of {sample_count} samples in [-1, 1[ (View on the buffer when possible)
+        """
+        noise_buffer = self.buffers[random.randrange(len(self.buffers))]
+        offset = random.randrange(len(noise_buffer))
+
+        if offset + sample_count <= len(noise_buffer):
+            return noise_buffer[offset:offset + sample_count]
+
+        return np.take(noise_buffer, np.arange(offset, offset + sample_count), mode='wrap')
+
+    def overlay(self, samples, gain):
+        """
+        Add the noise attenuated by {gain} dB to the integer {samples} (In place). The sum is clipped to the range of
+        the sample type
+        """
+        _, maxval = get_min_max_value(8 * samples.dtype.itemsize)
+        scale = maxval * db_to_float(gain)
+
+        noise = self.get_noise(len(samples)) * scale
+
+        sample_type_info = np.iinfo(samples.dtype)
+        mixed_samples = samples.astype(np.int64)
+        mixed_samples += noise.astype(np.int64)
+        np.clip(mixed_samples, sample_type_info.min, sample_type_info.max, out=mixed_samples)
+
+        samples[:] = mixed_samples
@@ -9,13 +9,69 @@
 
 import json
 import os
+import hashlib
 import numpy as np
 from pydub import AudioSegment
 from collections import defaultdict
-from copy import deepcopy
+from collections.abc import Mapping
+from multiprocessing import Pool
 
-from timbral_models import timbral_brightness
-from utils.audio_processing import get_perceptual_loudness
+from utils.sound_analysis_cache import Sound_Analysis_Cache, get_file_hash
+
+# Version of the raw sounds analysis. Must be bumped when analyse_elementary_sound() change to invalidate the cache
+ANALYSIS_VERSION = 1
+
+ANALYSIS_CACHE_FILENAME = '.analysis_cache.json'
+
+
+def analyse_elementary_sound(elementary_sound_filepath):
+    """
+    Compute the raw attributes of an elementary sound
+      - Duration in ms
+      - Perceptual loudness (ITU-R BS.1770-4 specification)
+      - Perceptual brightness
+    """
+    # timbral_models and pyloudnorm are slow to import. Only imported when a sound must be analysed (Not in cache)
+    from timbral_models import timbral_brightness
+    from utils.audio_processing import get_perceptual_loudness
+
+    elementary_sound_audiosegment = AudioSegment.from_wav(elementary_sound_filepath)
+
+    return {
+        'duration': int(elementary_sound_audiosegment.duration_seconds * 1000),
+        'raw_loudness': float(get_perceptual_loudness(elementary_sound_audiosegment)),
+        'raw_brightness': float(timbral_brightness(elementary_sound_filepath))
+    }
+
+
+class Elementary_Sound(Mapping):
+    """
+    Immutable record of the attributes of an elementary sound
+    Records are shared by all the scenes containing the sound. The attributes specific to a scene object
+    (Ex : silence_after) are merged in a new dict with to_dict() when the scene is created
+    """
+    __slots__ = ('_attributes',)
+
+    def __init__(self, attributes):
+        self._attributes = dict(attributes)
+
+    def __getitem__(self, key):
+        return self._attributes[key]
+
+    def __iter__(self):
+        return iter(self._attributes)
+
+    def __len__(self):
+        return len(self._attributes)
+
+    def __repr__(self):
+        return 'Elementary_Sound(%s)' % self._attributes
+
+    def to_dict(self, **overlay):
+        attributes = dict(self._attributes)
+        attributes.update(overlay)
+
+        return attributes
 
 
 class Elementary_Sounds:
@@ -25,11 +81,20 @@ class Elementary_Sounds:
       - Preprocess the sounds
         - Analyse sounds and add new attributes to the definition
       - Give an interface to retrieve sounds
+    The raw analysis values are cached in {folder_path}/.analysis_cache.json (Unless {use_analysis_cache} is False)
+    The sounds missing from the cache are analysed in {analysis_nb_process} processes
     """
 
-    def __init__(self, folder_path, definition_filename, save_raw_values=False):
+    def __init__(self, folder_path, definition_filename, save_raw_values=False, use_analysis_cache=True,
+                 analysis_nb_process=None):
         print("Loading Elementary sounds")
         self.folderpath = folder_path
+        self.analysis_nb_process = analysis_nb_process
+
+        if use_analysis_cache:
+            self.analysis_cache_filepath = os.path.join(self.folderpath, ANALYSIS_CACHE_FILENAME)
+        else:
+            self.analysis_cache_filepath = None
 
         with open(os.path.join(self.folderpath, definition_filename)) as file:
             self.definition = json.load(file)
@@ -46,6 +111,9 @@ class Elementary_Sounds:
 
         self.id_list = [sound['id'] for sound in self.definition]
 
+        # Shared immutable records returned by get()
+        self.records = [Elementary_Sound(sound) for sound in self.definition]
+
         self.id_list_shuffled = self.id_list.copy()
 
         for sound in self.definition:
@@ -57,13 +125,19 @@ class Elementary_Sounds:
         self.families = self.families_count.keys()
         self.nb_families = len(self.families)
 
+        # Per-sound arrays indexed by sound id. Used to validate batches of candidate scenes with numpy operations
+        family_to_code = {family: code for code, family in enumerate(self.families)}
+        self.family_codes = np.array([family_to_code[sound['instrument']] for sound in self.definition], dtype=np.int32)
+        self.durations = np.array([sound['duration'] for sound in self.definition], dtype=np.int64)
+        self.attribute_codes = {}
+
         self.generated_count_by_index = {i: 0 for i in range(self.nb_sounds)}
         self.generated_count_by_families = {fam: 0 for fam in self.families}
         self.gen_index = 0
 
     def get(self, index):
-        # Return copy of element to prevent augmented attribute overwriting
-        return deepcopy(self.definition[index])
+        # Records are immutable and shared, scene specific attributes must be added with to_dict()
+        return self.records[index]
 
     def __getitem__(self, item):
         return self.get(item)
@@ -71,6 +145,30 @@ class Elementary_Sounds:
     def __len__(self):
         return self.nb_sounds
 
+    def get_definition_hash(self):
+        """
+        Digest of the preprocessed definition (Sound ids, files and attributes). Identify the bank the scenes refer to
+        """
+        return hashlib.sha256(json.dumps(self.definition, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_attribute_codes(self, attribute):
+        """
+        Return an array containing the code of {attribute} for each sound (Indexed by sound id)
+        and the list of values corresponding to each code (None values are given their own code)
+        """
+        if attribute not in self.attribute_codes:
+            values = []
+            codes = []
+            for sound in self.definition:
+                value = sound[attribute]
+                if value not in values:
+                    values.append(value)
+                codes.append(values.index(value))
+
+            self.attribute_codes[attribute] = (np.array(codes, dtype=np.int32), values)
+
+        return self.attribute_codes[attribute]
+
     def _preprocess_sounds(self, save_raw_values, shuffle_sounds=True):
         """
         Apply some preprocessing on the loaded sounds
@@ -78,45 +176,26 @@ class Elementary_Sounds:
           - Calculate perceptual brightness and assign "Bright", "Dark" or None label
           - Retrieve the sound duration
           - Packup the info in the sound dict
+        The raw values are read from the analysis cache when available. Only the normalization and the labelling
+        are done on every run
         """
 
         if shuffle_sounds:
             np.random.shuffle(self.definition)
 
-        max_brightness = -9999
-        min_brightness = 9999
-        max_loudness = -9999
-        min_loudness = 9999
+        self._analyse_sounds()
 
-        for id, elementary_sound in enumerate(self.definition):
-            elementary_sound_filename = os.path.join(self.folderpath, elementary_sound['filename'])
-            elementary_sound_audiosegment = AudioSegment.from_wav(elementary_sound_filename)
+        max_brightness = max(elementary_sound['raw_brightness'] for elementary_sound in self.definition)
+        min_brightness = min(elementary_sound['raw_brightness'] for elementary_sound in self.definition)
+        max_loudness = max(elementary_sound['raw_loudness'] for elementary_sound in self.definition)
+        min_loudness = min(elementary_sound['raw_loudness'] for elementary_sound in self.definition)
 
+        # Normalize the brightness per instrument and assign the brightness label
+        for id, elementary_sound in enumerate(self.definition):
             elementary_sound['id'] = id
 
-            elementary_sound['duration'] = int(elementary_sound_audiosegment.duration_seconds * 1000)
-
-            perceptual_loudness = get_perceptual_loudness(elementary_sound_audiosegment)
-            elementary_sound['raw_loudness'] = perceptual_loudness
-
             self.sorted_durations.append(elementary_sound['duration'])
 
-            elementary_sound['raw_brightness'] = timbral_brightness(elementary_sound_filename)
-
-            if min_brightness > elementary_sound['raw_brightness']:
-                min_brightness = elementary_sound['raw_brightness']
-
-            if max_brightness < elementary_sound['raw_brightness']:
-                max_brightness = elementary_sound['raw_brightness']
-
-            if min_loudness > elementary_sound['raw_loudness']:
-                min_loudness = elementary_sound['raw_loudness']
-
-            if max_loudness < elementary_sound['raw_loudness']:
-                max_loudness = elementary_sound['raw_loudness']
-
-        # Normalize the brightness per instrument and assign the brightness label
-        for id, elementary_sound in enumerate(self.definition):
             # Normalize attributes
             normalized_brightness = (elementary_sound['raw_brightness'] - min_brightness) / (max_brightness - min_brightness)
             normalized_loudness = (elementary_sound['raw_loudness'] - min_loudness) / (max_loudness - min_loudness)
@@ -145,6 +224,50 @@ class Elementary_Sounds:
         self.sorted_durations = sorted(self.sorted_durations)
         self.half_longest_durations_mean = np.mean(self.sorted_durations[-int(self.nb_sounds/2):])
 
+    def _analyse_sounds(self):
+        """
+        Add the raw analysis values (duration, raw_loudness, raw_brightness) to the definition of each sound
+        Sounds that are not in the analysis cache are analysed and added to the cache
+        The sounds are analysed in {self.analysis_nb_process} processes when it is bigger than 1. Each sound is analysed
+        independently, the results are the same as the sequential analysis
+        """
+        analysis_cache = None
+        if self.analysis_cache_filepath is not None:
+            analysis_cache = Sound_Analysis_Cache(self.analysis_cache_filepath, ANALYSIS_VERSION)
+
+        # Retrieve the cached values and list the sounds to analyse
+        to_analyse = []
+        for elementary_sound in self.definition:
+            elementary_sound_filepath = os.path.join(self.folderpath, elementary_sound['filename'])
+
+            file_hash = None
+            if analysis_cache is not None:
+                file_hash = get_file_hash(elementary_sound_filepath)
+                raw_values = analysis_cache.get(file_hash)
+
+                if raw_values is not None:
+                    elementary_sound.update(raw_values)
+                    continue
+
+            to_analyse.append((elementary_sound, elementary_sound_filepath, file_hash))
+
+        filepaths = [elementary_sound_filepath for _, elementary_sound_filepath, _ in to_analyse]
+        if self.analysis_nb_process is not None and self.analysis_nb_process > 1 and len(filepaths) > 1:
+            with Pool(min(self.analysis_nb_process, len(filepaths))) as pool:
+                analysis_results = pool.map(analyse_elementary_sound, filepaths)
+        else:
+            analysis_results = [analyse_elementary_sound(filepath) for filepath in filepaths]
+
+        for (elementary_sound, _, file_hash), raw_values in zip(to_analyse, analysis_results):
+            elementary_sound.update(raw_values)
+
+            if analysis_cache is not None:
+                analysis_cache.set(file_hash, raw_values)
+
+        if analysis_cache is not None:
+            analysis_cache.save()
+            print("Analysed %d elementary sounds (%d from cache)" % (len(to_analyse), self.nb_sounds - len(to_analyse)))
+
     def sounds_to_families_count(self, sound_list):
         """
         Return the frequence of each instrument family
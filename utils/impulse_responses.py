@@ -0,0 +1,212 @@
+# CLEAR Dataset
+# >> Reverberation Impulse Responses
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.audio_processing import add_reverberation_numpy
+
+"""
+    Convolution reverberation
+      - The reverberated part of add_reverberation_numpy() is linear and time invariant. It is fully described by its
+        impulse response, which is synthesized once for each room scale
+      - The pre delay only shift the reverberated signal. It is applied when mixing instead of being part of the
+        impulse response so that one impulse response serve all the delays of a room scale
+      - The impulse response is truncated when it decay under {truncation_db} dB of its peak
+      - The signal is convolved with the impulse response by FFT overlap-add
+      - Since the reverberation is linear, the reverberated part of a scene is also the sum of the reverberated part
+        of each of its sounds shifted to the sound onset. Reverberated_Sound_Cache keep the reverberated sounds so
+        that a scene only cost copies and additions once the sounds are cached
+      - Reverberating a sound cost about a third of reverberating a whole scene. The cache only pay off when the same
+        (sound, room scale) are reused, the room scale must be quantized to few values
+"""
+
+
+def next_power_of_2(value):
+    return 1 << max(int(value) - 1, 0).bit_length()
+
+
+class Impulse_Response:
+    """
+    Impulse response of the reverberated part of the signal and its spectrum at {fft_size}
+    The signal is processed in blocks of {block_length} samples so that each block convolution fit in {fft_size}
+    Signals shorter than a block are convolved in a single transform of the smallest size that fit them
+    """
+    __slots__ = ('samples', 'length', 'fft_size', 'block_length', 'spectrum', 'spectrums')
+
+    def __init__(self, samples, min_fft_size=4096):
+        self.samples = np.asarray(samples, dtype=np.float32)
+        self.length = len(samples)
+        self.fft_size = max(next_power_of_2(2 * self.length), min_fft_size)
+        self.block_length = self.fft_size - self.length + 1
+        self.spectrum = np.fft.rfft(samples, self.fft_size).astype(np.complex64)
+        self.spectrums = {self.fft_size: self.spectrum}
+
+    def get_spectrum(self, fft_size):
+        if fft_size not in self.spectrums:
+            self.spectrums[fft_size] = np.fft.rfft(self.samples, fft_size).astype(np.complex64)
+
+        return self.spectrums[fft_size]
+
+    def convolve(self, signal, output_length=None):
+        """
+        FFT overlap-add convolution of {signal} with the impulse response
+        The output is truncated to {output_length} samples (Default to the length of {signal})
+        """
+        output_length = len(signal) if output_length is None else output_length
+        signal_length = min(len(signal), output_length)
+
+        fft_size = next_power_of_2(signal_length + self.length - 1)
+        if fft_size < self.fft_size:
+            output = np.zeros(max(output_length, fft_size), dtype=np.float64)
+            output[:fft_size] = np.fft.irfft(np.fft.rfft(signal[:signal_length], fft_size) *
+                                             self.get_spectrum(fft_size), fft_size)
+            return output[:output_length]
+
+        output = np.zeros(output_length + self.fft_size, dtype=np.float64)
+
+        for start in range(0, signal_length, self.block_length):
+            block = signal[start:start + self.block_length]
+            block_output = np.fft.irfft(np.fft.rfft(block, self.fft_size) * self.spectrum, self.fft_size)
+            output[start:start + self.fft_size] += block_output
+
+        return output[:output_length]
+
+
+def synthesize_impulse_response(frame_rate, room_scale, reverberance=100, hf_damping=50, wet_gain=0,
+                                max_duration=10, truncation_db=-60):
+    """
+    Impulse response of the reverberated part of add_reverberation_numpy() (Without the pre delay)
+    """
+    impulse = np.zeros(int(max_duration * frame_rate))
+    impulse[0] = 1
+
+    response = add_reverberation_numpy(impulse, frame_rate=frame_rate, reverberance=reverberance,
+                                       hf_damping=hf_damping, room_scale=room_scale, pre_delay=0, wet_gain=wet_gain,
+                                       wet_only=True)
+
+    envelope = np.abs(response)
+    above_threshold = np.nonzero(envelope > envelope.max() * 10 ** (truncation_db / 20))[0]
+    length = above_threshold[-1] + 1 if len(above_threshold) > 0 else 1
+
+    return response[:length]
+
+
+class Impulse_Response_Bank:
+    """
+    LRU cache of the impulse responses, indexed by room scale
+    The impulse responses are synthesized on the first use. Each worker process has its own bank
+    """
+
+    def __init__(self, frame_rate, max_size=32, max_duration=10, truncation_db=-60):
+        self.frame_rate = frame_rate
+        self.max_size = max_size
+        self.max_duration = max_duration
+        self.truncation_db = truncation_db
+        self.impulse_responses = OrderedDict()
+        self.nb_synthesized = 0
+
+    def get(self, room_scale):
+        if room_scale in self.impulse_responses:
+            self.impulse_responses.move_to_end(room_scale)
+            return self.impulse_responses[room_scale]
+
+        samples = synthesize_impulse_response(self.frame_rate, room_scale, max_duration=self.max_duration,
+                                              truncation_db=self.truncation_db)
+        impulse_response = Impulse_Response(samples)
+        self.nb_synthesized += 1
+
+        self.impulse_responses[room_scale] = impulse_response
+        if len(self.impulse_responses) > self.max_size:
+            self.impulse_responses.popitem(last=False)
+
+        return impulse_response
+
+    def add_reverberation(self, sound, room_scale, pre_delay):
+        """
+        Same result as add_reverberation_numpy() with the default parameters (Up to the impulse response truncation)
+        """
+        pre_delay_length = min(int(self.frame_rate * pre_delay / 1000 + 0.5), len(sound))
+
+        sound = np.asarray(sound, dtype=np.float64)
+        output = sound.copy()
+        output[pre_delay_length:] += self.get(room_scale).convolve(sound, len(sound) - pre_delay_length)
+
+        return np.clip(output, -1, 1 - 2.0 ** -31, out=output)
+
+
+class Reverberated_Sound_Cache:
+    """
+    LRU cache of the reverberated part of the elementary sounds, indexed by (sound key, room scale)
+    Only the part of the tail used by the scene is kept as float32. The whole tail is kept once a scene need more of it
+    The cache is limited to {max_bytes}. Each worker process has its own cache
+    """
+
+    def __init__(self, impulse_response_bank, max_bytes=512 * 1024 * 1024):
+        self.impulse_response_bank = impulse_response_bank
+        self.max_bytes = max_bytes
+        self.nb_bytes = 0
+        self.reverberated_sounds = OrderedDict()
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def get(self, sound_key, load_sound, room_scale, length):
+        """
+        First {length} samples of the reverberated part of a sound (Shorter if the whole tail is shorter)
+        {sound_key} must identify the samples of the sound
+        {load_sound} return the samples of the sound as a float array. It is only called if the sound is not cached
+        """
+        key = (sound_key, room_scale)
+        if key in self.reverberated_sounds:
+            reverberated, is_complete = self.reverberated_sounds[key]
+            if is_complete or len(reverberated) >= length:
+                self.nb_hits += 1
+                self.reverberated_sounds.move_to_end(key)
+                return reverberated
+
+            # The cached part is too short for this scene. The whole tail is computed so that it is not extended again
+            del self.reverberated_sounds[key]
+            self.nb_bytes -= reverberated.nbytes
+            length = None
+
+        self.nb_misses += 1
+        sound = load_sound()
+        impulse_response = self.impulse_response_bank.get(room_scale)
+        tail_length = len(sound) + impulse_response.length - 1
+        is_complete = length is None or length >= tail_length
+        reverberated = impulse_response.convolve(sound, tail_length if is_complete else length).astype(np.float32)
+
+        self.reverberated_sounds[key] = (reverberated, is_complete)
+        self.nb_bytes += reverberated.nbytes
+        while self.nb_bytes > self.max_bytes and len(self.reverberated_sounds) > 1:
+            _, (evicted, _) = self.reverberated_sounds.popitem(last=False)
+            self.nb_bytes -= evicted.nbytes
+
+        return reverberated
+
+    def add_reverberation(self, scene, sounds, room_scale, pre_delay):
+        """
+        Same result as Impulse_Response_Bank.add_reverberation() on {scene} (Float array)
+        {sounds} is a list of (sound_key, load_sound, onset) describing the sounds of the scene (See get()).
+        The scene must not contain anything else than the sounds (The rest of the scene is not reverberated)
+        """
+        pre_delay_length = int(self.impulse_response_bank.frame_rate * pre_delay / 1000 + 0.5)
+
+        output = np.array(scene, dtype=np.float64)
+        for sound_key, load_sound, onset in sounds:
+            start = onset + pre_delay_length
+            if start >= len(output):
+                continue
+
+            reverberated = self.get(sound_key, load_sound, room_scale, len(output) - start)
+            length = min(len(reverberated), len(output) - start)
+            output[start:start + length] += reverberated[:length]
+
+        return np.clip(output, -1, 1 - 2.0 ** -31, out=output)
@@ -15,6 +15,7 @@ from pydub.utils import get_array_type
 import random
 import time
 import json
+import hashlib
 
 
 def init_random_seed(seed):
@@ -25,6 +26,16 @@ def init_random_seed(seed):
     np.random.seed(seed)
 
 
+def get_derived_seed(seed, *keys):
+    """
+    Derive a 32 bits seed from a global seed and a list of keys (Ex : set type and scene index)
+    The derived seed only depend on the values, a given item get the same seed in any process and in any order
+    """
+    digest = hashlib.sha256(':'.join(str(value) for value in (seed,) + keys).encode('utf-8')).digest()
+
+    return int.from_bytes(digest[:4], byteorder='little')
+
+
 def save_arguments(args, folder_path, filename):
     """
     Arguments saving
@@ -50,45 +61,57 @@ to_pydub_bit_depth_to_np_type = {
 }
 
 
-def pydub_audiosegment_to_float_array(audio_segment, frame_rate, n_bytes):
-    """Convert an integer buffer to floating point values.
-    This is primarily useful when loading integer-valued wav data
-    into numpy arrays.
+def get_sample_dtype(n_bytes):
+    return np.dtype('<i{:d}'.format(n_bytes))
 
-    Taken from https://librosa.github.io/librosa/_modules/librosa/util/utils.html#buf_to_float
 
-    NOTE : This will only work for mono audio segment because of the way data is ordered in a pydub audio segment
-    NOTE : See https://groups.google.com/d/msg/librosa/XWae4PdbXuk/4LjHK3d4BAAJ for a fix
+def int_samples_to_float_array(samples, n_bytes):
+    """
+    Scale integer samples to floating point values in [-1, 1]
     """
-
     bit_depth = 8 * n_bytes
 
     # Invert the scale of the data
     scale = 1. / float(1 << (bit_depth - 1))
 
-    # Construct the format string
-    fmt = '<i{:d}'.format(n_bytes)
+    return np.multiply(samples, scale, dtype=from_pydub_bit_depth_to_np_type[bit_depth])
 
-    np_arr = np.frombuffer(audio_segment._data, fmt)
 
-    scaled = np.multiply(np_arr, scale, dtype=from_pydub_bit_depth_to_np_type[bit_depth])
-
-    return scaled
-
-
-def float_array_to_pydub_audiosegment(float_array, frame_rate, n_bytes):
+def float_array_to_int_samples(float_array, n_bytes):
     bit_depth = 8 * n_bytes
     # Revert the scale of the data
     scale = float(1 << ((bit_depth) - 1))
 
-    scaled = np.multiply(scale, float_array).astype(to_pydub_bit_depth_to_np_type[bit_depth])
+    return np.multiply(scale, float_array).astype(to_pydub_bit_depth_to_np_type[bit_depth])
 
-    return AudioSegment(scaled.tobytes(),
+
+def int_samples_to_pydub_audiosegment(samples, frame_rate, n_bytes):
+    return AudioSegment(samples.astype(get_sample_dtype(n_bytes), copy=False).tobytes(),
                         frame_rate=frame_rate,
                         sample_width=n_bytes,
                         channels=1)
 
 
+def pydub_audiosegment_to_float_array(audio_segment, frame_rate, n_bytes):
+    """Convert an integer buffer to floating point values.
+    This is primarily useful when loading integer-valued wav data
+    into numpy arrays.
+
+    Taken from https://librosa.github.io/librosa/_modules/librosa/util/utils.html#buf_to_float
+
+    NOTE : This will only work for mono audio segment because of the way data is ordered in a pydub audio segment
+    NOTE : See https://groups.google.com/d/msg/librosa/XWae4PdbXuk/4LjHK3d4BAAJ for a fix
+    """
+
+    np_arr = np.frombuffer(audio_segment._data, get_sample_dtype(n_bytes))
+
+    return int_samples_to_float_array(np_arr, n_bytes)
+
+
+def float_array_to_pydub_audiosegment(float_array, frame_rate, n_bytes):
+    return int_samples_to_pydub_audiosegment(float_array_to_int_samples(float_array, n_bytes), frame_rate, n_bytes)
+
+
 def get_max_scene_length(scenes):
   return np.max([len(scene['objects']) for scene in scenes])
 
@@ -75,12 +75,28 @@ def not_unique_handler(scene_struct, inputs, value_inputs):
     return inputs[0]
 
 
+# Temporal relationships are implied by the position of the objects in the scene.
+# They are derived on demand instead of being read from the scene definition
+relationship_types = ['before', 'after']
+
+
+def get_related_objects(scene_struct, relation, idx):
+    """
+    Return the range of object indexes that are {relation} the object {idx}
+    """
+    if relation == 'before':
+        return range(0, idx)
+    elif relation == 'after':
+        return range(idx + 1, len(scene_struct['objects']))
+    else:
+        assert False, 'Unknown relationship "%s"' % relation
+
+
 def relate_handler(scene_struct, inputs, value_inputs):
     assert len(inputs) == 1
     assert len(value_inputs) == 1
     relation = value_inputs[0]
-    relation_index = scene_struct['_relationships_indexes'][relation]
-    return scene_struct['relationships'][relation_index]['indexes'][inputs[0]]
+    return list(get_related_objects(scene_struct, relation, inputs[0]))
 
 
 def union_handler(scene_struct, inputs, value_inputs):
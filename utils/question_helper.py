@@ -27,6 +27,7 @@ from itertools import groupby
 import json
 import numpy as np
 import utils.question_engine as qeng
+from utils.scene_io import load_scene_file
 
 """
     Helper functions for the Question Generator
@@ -128,12 +129,9 @@ def load_and_prepare_templates(template_dir, metadata):
 
 
 def load_scenes(scene_filepath, start_idx, nb_scenes_to_gen):
-    # Read file containing input scenes
-    with open(scene_filepath, 'r') as f:
-        scene_data = json.load(f)
-        scenes = scene_data['scenes']
-        nb_scenes_loaded = len(scenes)
-        scene_info = scene_data['info']
+    # Read file containing input scenes (Single JSON file, JSON Lines or chunked JSON files)
+    scenes, scene_info = load_scene_file(scene_filepath)
+    nb_scenes_loaded = len(scenes)
 
     if nb_scenes_to_gen > 0:
         end = start_idx + nb_scenes_to_gen
@@ -185,12 +183,9 @@ def load_and_prepare_metadata(metadata_filepath, scenes):
             if count > instrument_count[instrument]:
                 instrument_count[instrument] = count
 
-        # Insert reference from relation label (Ex: before, after, ..) to index in scene['relationships']
-        # Again for performance. Faster than searching in the dict every time
-        scene['_relationships_indexes'] = {}
-        for i, relation_data in enumerate(scene['relationships']):
-            scene['_relationships_indexes'][relation_data['type']] = i
-
+        # Relationships are derived from the objects position by the question engine
+        if 'relationships' in scene:
+            del scene['relationships']
 
     # Limit the position values according to the max scene length
     metadata['attributes']['position']['values'] = metadata['attributes']['position']['values'][:max_scene_length]
@@ -323,7 +318,7 @@ def find_relate_filter_options(object_idx, scene_struct, attr, can_be_null_attri
     if '_filter_options' not in scene_struct or filter_key not in scene_struct['_filter_options']:
         precompute_filter_options(scene_struct, attr, can_be_null_attributes)
 
-    nb_filters = len(scene_struct['_filter_options'][filter_key].keys()) * len(scene_struct['relationships'])
+    nb_filters = len(scene_struct['_filter_options'][filter_key].keys()) * len(qeng.relationship_types)
     nb_trivial = int(round(nb_filters * trivial_frac / (1 - trivial_frac)))
 
     # TODO: Right now this is only looking for nontrivial combinations; in some cases I may want to add trivial
@@ -333,14 +328,13 @@ def find_relate_filter_options(object_idx, scene_struct, attr, can_be_null_attri
     non_trivial_options_keys = []
     all_options = {}
 
-    for relationship in scene_struct['relationships']:
-        relationship_index = scene_struct['_relationships_indexes'][relationship['type']]
-        related = set(scene_struct['relationships'][relationship_index]['indexes'][object_idx])
+    for relationship_type in qeng.relationship_types:
+        related = qeng.get_related_objects(scene_struct, relationship_type, object_idx)
         if len(related) == 0:
             # If no relation, the object is the first (No before relations) or the last (No after relations)
             continue
         for filters, filtered in scene_struct['_filter_options'][filter_key].items():
-            intersection = related & filtered
+            intersection = set(idx for idx in filtered if idx in related)
             trivial = (intersection == filtered)
             if unique and len(intersection) != 1:
                 continue
@@ -349,7 +343,7 @@ def find_relate_filter_options(object_idx, scene_struct, attr, can_be_null_attri
             if not include_zero and len(intersection) == 0:
                 continue
 
-            key = (relationship['type'], filters)
+            key = (relationship_type, filters)
             if trivial:
                 trivial_options_keys.append(key)
             else:
@@ -361,9 +355,9 @@ def find_relate_filter_options(object_idx, scene_struct, attr, can_be_null_attri
 
     # NOTE : Looping a second time is really ineficient..
     #        We do it to make sure that we keep the same order in the dict to ensure reproducibility
-    for relationship in scene_struct['relationships']:
+    for relationship_type in qeng.relationship_types:
         for filters, filtered in scene_struct['_filter_options'][filter_key].items():
-            key = (relationship['type'], filters)
+            key = (relationship_type, filters)
             if key in options_to_keep:
                 options[key] = all_options[key]
 
@@ -0,0 +1,82 @@
+# CLEAR Dataset
+# >> Generated Scenes Duplicate Index
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+import sys
+import hashlib
+import numpy as np
+
+
+class Scene_Dedup_Index:
+    """
+    Index of the accepted scenes used to detect duplicates during the scene generation
+      - Scenes are identified by their ordered list of elementary sound ids
+      - The ids are packed in the smallest integer type that can hold all the sound ids
+      - Packed keys longer than {max_packed_key_size} bytes are replaced by their 128 bits digest
+    """
+
+    def __init__(self, nb_sounds, max_packed_key_size=16):
+        if nb_sounds <= np.iinfo(np.uint8).max + 1:
+            self.id_dtype = np.uint8
+        elif nb_sounds <= np.iinfo(np.uint16).max + 1:
+            self.id_dtype = np.uint16
+        else:
+            self.id_dtype = np.uint32
+
+        self.max_packed_key_size = max_packed_key_size
+        self.keys = set()
+        self.keys_size = 0
+
+    def _get_key(self, scene_id_list):
+        key = np.array(scene_id_list, dtype=self.id_dtype).tobytes()
+
+        if len(key) > self.max_packed_key_size:
+            key = hashlib.blake2b(key, digest_size=16).digest()
+
+        return key
+
+    def add(self, scene_id_list):
+        """
+        Add the scene to the index. Return False if the scene was already in the index
+        """
+        key = self._get_key(scene_id_list)
+
+        if key in self.keys:
+            return False
+
+        self.keys.add(key)
+        self.keys_size += sys.getsizeof(key)
+
+        return True
+
+    def copy(self):
+        index_copy = Scene_Dedup_Index.__new__(Scene_Dedup_Index)
+        index_copy.id_dtype = self.id_dtype
+        index_copy.max_packed_key_size = self.max_packed_key_size
+        index_copy.keys = set(self.keys)
+        index_copy.keys_size = self.keys_size
+
+        return index_copy
+
+    def __contains__(self, scene_id_list):
+        return self._get_key(scene_id_list) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def memory_footprint(self):
+        """
+        Approximate memory used by the index in bytes (Hash table + keys)
+        """
+        return sys.getsizeof(self.keys) + self.keys_size
+
+    def get_stats(self):
+        return {
+            'nb_scenes': len(self.keys),
+            'memory_footprint': self.memory_footprint()
+        }
@@ -0,0 +1,274 @@
+# CLEAR Dataset
+# >> Scene Files Reading & Writing
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+import os
+import json
+from glob import glob, escape as glob_escape
+from collections.abc import Mapping
+
+"""
+    Scene files layouts
+        - json          : One JSON file per set containing the info section and all the scenes (Written at the end)
+                          {prefix}_{set_type}_scenes.json
+        - jsonl         : One JSON Lines file per set. The first line contain the info section, each following line
+                          contain one scene. Scenes are written as they are generated
+                          {prefix}_{set_type}_scenes.jsonl
+        - chunked_json  : Multiple JSON files per set containing {scenes_per_chunk} scenes and the info section.
+                          Scenes are written as soon as a chunk is full
+                          {prefix}_{set_type}_scenes_{chunk_index}.json
+
+    Scene objects formats
+        - full          : Each object contain all the attributes of its elementary sound and its 'silence_after'
+        - compact       : Each object only contain the 'id' of its elementary sound and its 'silence_after'.
+                          The elementary sounds attributes are written once in {prefix}_elementary_sounds.json
+                          (Referenced by the 'elementary_sounds_filename' key of the info section)
+
+    Appending to an existing set
+        - json          : The file is rewritten with the existing and the new scenes
+        - jsonl         : The new scenes are appended at the end of the file
+        - chunked_json  : The new scenes are written in new chunks following the existing ones
+    The random generators state at the end of the generation is saved in {prefix}_generation_state.json
+"""
+
+scene_file_formats = ['json', 'jsonl', 'chunked_json']
+
+
+def get_scene_filepath(scenes_folder, prefix, set_type):
+    return os.path.join(scenes_folder, '%s_%s_scenes.json' % (prefix, set_type))
+
+
+def get_elementary_sounds_filename(prefix):
+    return '%s_elementary_sounds.json' % prefix
+
+
+def get_generation_state_filepath(scenes_folder, prefix):
+    return os.path.join(scenes_folder, '%s_generation_state.json' % prefix)
+
+
+def get_jsonl_filepath(scene_filepath):
+    return os.path.splitext(scene_filepath)[0] + '.jsonl'
+
+
+def get_chunk_filepath(scene_filepath, chunk_index):
+    return os.path.splitext(scene_filepath)[0] + '_%05d.json' % chunk_index
+
+
+def get_chunk_filepaths(scene_filepath):
+    pattern = glob_escape(os.path.splitext(scene_filepath)[0]) + '_[0-9][0-9][0-9][0-9][0-9].json'
+    return sorted(glob(pattern))
+
+
+def get_scene_file_format(scene_filepath):
+    """
+    Return the layout of the existing scene file(s) of a set or None if there is no scene file
+    """
+    if os.path.isfile(scene_filepath):
+        return 'json'
+    elif os.path.isfile(get_jsonl_filepath(scene_filepath)):
+        return 'jsonl'
+    elif len(get_chunk_filepaths(scene_filepath)) > 0:
+        return 'chunked_json'
+
+    return None
+
+
+class Scene_Object(Mapping):
+    """
+    Read-only view of a compact scene object
+    The attributes specific to the object (Ex : silence_after) are read from {overlay}, the other attributes are read
+    from the shared elementary sound definition. No attribute is copied
+    """
+    __slots__ = ('sound', 'overlay')
+
+    def __init__(self, sound, overlay):
+        self.sound = sound
+        self.overlay = overlay
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+
+        return self.sound[key]
+
+    def __iter__(self):
+        yield from self.sound
+        for key in self.overlay:
+            if key not in self.sound:
+                yield key
+
+    def __len__(self):
+        return len(self.sound) + sum(1 for key in self.overlay if key not in self.sound)
+
+    def __repr__(self):
+        return 'Scene_Object(%s)' % dict(self)
+
+
+def expand_compact_scenes(scenes, elementary_sounds):
+    """
+    Replace the compact objects of {scenes} by Scene_Object views on {elementary_sounds} (Indexed by sound id)
+    """
+    sounds_by_id = {sound['id']: sound for sound in elementary_sounds}
+
+    for scene in scenes:
+        scene['objects'] = [Scene_Object(sounds_by_id[obj['id']], obj) for obj in scene['objects']]
+
+    return scenes
+
+
+class Json_Scene_Writer:
+    """
+    Keep all the scenes in memory and write them in one JSON file when closed
+    When appending, the existing scenes are loaded and the existing info section is kept
+    """
+    def __init__(self, scene_filepath, info, append=False):
+        self.scene_filepath = scene_filepath
+
+        if append:
+            self.scenes, self.info = _load_scene_file(scene_filepath)
+        else:
+            self.info = info
+            self.scenes = []
+
+    def write(self, scene):
+        self.scenes.append(scene)
+
+    def close(self):
+        with open(self.scene_filepath, 'w') as f:
+            json.dump({
+                'info': self.info,
+                'scenes': self.scenes
+            }, f, indent=2, sort_keys=True)
+
+
+class Jsonl_Scene_Writer:
+    """
+    Write the info section on the first line and then one scene per line
+    When appending, the scenes are added at the end of the existing file
+    """
+    def __init__(self, scene_filepath, info, append=False):
+        self.scene_filepath = get_jsonl_filepath(scene_filepath)
+
+        if append:
+            self.file = open(self.scene_filepath, 'a')
+        else:
+            self.file = open(self.scene_filepath, 'w')
+            self.file.write(json.dumps({'info': info}, sort_keys=True) + '\n')
+
+    def write(self, scene):
+        self.file.write(json.dumps(scene, sort_keys=True) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class Chunked_Json_Scene_Writer:
+    """
+    Write the scenes in multiple JSON files of {scenes_per_chunk} scenes
+    When appending, the new chunks are numbered after the existing ones
+    """
+    def __init__(self, scene_filepath, info, scenes_per_chunk, append=False):
+        self.scene_filepath = scene_filepath
+        self.info = info
+        self.scenes_per_chunk = scenes_per_chunk
+        self.chunk_index = len(get_chunk_filepaths(scene_filepath)) if append else 0
+        self.scenes = []
+
+    def _write_chunk(self):
+        chunk_filepath = get_chunk_filepath(self.scene_filepath, self.chunk_index)
+
+        info = dict(self.info)
+        info['chunk_index'] = self.chunk_index
+
+        with open(chunk_filepath, 'w') as f:
+            json.dump({
+                'info': info,
+                'scenes': self.scenes
+            }, f, indent=2, sort_keys=True)
+
+        self.chunk_index += 1
+        self.scenes = []
+
+    def write(self, scene):
+        self.scenes.append(scene)
+
+        if len(self.scenes) >= self.scenes_per_chunk:
+            self._write_chunk()
+
+    def close(self):
+        if len(self.scenes) > 0 or self.chunk_index == 0:
+            self._write_chunk()
+
+
+def create_scene_writer(output_format, scene_filepath, info, scenes_per_chunk=1000, append=False):
+    if output_format == 'json':
+        return Json_Scene_Writer(scene_filepath, info, append)
+    elif output_format == 'jsonl':
+        return Jsonl_Scene_Writer(scene_filepath, info, append)
+    elif output_format == 'chunked_json':
+        return Chunked_Json_Scene_Writer(scene_filepath, info, scenes_per_chunk, append)
+    else:
+        assert False, 'Unknown scene file format "%s"' % output_format
+
+
+def load_scene_file(scene_filepath, expand_compact=True):
+    """
+    Load the scenes and the info section of a set
+    {scene_filepath} is the path of the single JSON file ({prefix}_{set_type}_scenes.json).
+    If it doesn't exist, the JSON Lines file and then the chunked JSON files are used instead
+    Compact scenes are expanded using the elementary sounds definition written alongside the scenes
+    (Unless {expand_compact} is False)
+    """
+    scenes, scene_info = _load_scene_file(scene_filepath)
+
+    if expand_compact and scene_info.get('scene_format') == 'compact':
+        elementary_sounds_filepath = os.path.join(os.path.dirname(scene_filepath),
+                                                  scene_info['elementary_sounds_filename'])
+        with open(elementary_sounds_filepath, 'r') as f:
+            elementary_sounds = json.load(f)
+
+        scenes = expand_compact_scenes(scenes, elementary_sounds)
+
+    return scenes, scene_info
+
+
+def _load_scene_file(scene_filepath):
+    if os.path.isfile(scene_filepath):
+        with open(scene_filepath, 'r') as f:
+            scene_data = json.load(f)
+
+        return scene_data['scenes'], scene_data['info']
+
+    jsonl_filepath = get_jsonl_filepath(scene_filepath)
+    if os.path.isfile(jsonl_filepath):
+        scenes = []
+        with open(jsonl_filepath, 'r') as f:
+            scene_info = json.loads(f.readline())['info']
+            for line in f:
+                if line.strip():
+                    scenes.append(json.loads(line))
+
+        return scenes, scene_info
+
+    chunk_filepaths = get_chunk_filepaths(scene_filepath)
+    if len(chunk_filepaths) > 0:
+        scenes = []
+        scene_info = None
+        for chunk_filepath in chunk_filepaths:
+            with open(chunk_filepath, 'r') as f:
+                chunk_data = json.load(f)
+
+            if scene_info is None:
+                scene_info = chunk_data['info']
+                del scene_info['chunk_index']
+
+            scenes += chunk_data['scenes']
+
+        return scenes, scene_info
+
+    raise FileNotFoundError("Could not find the scenes file '%s' (Or its jsonl/chunked equivalent)" % scene_filepath)
@@ -0,0 +1,70 @@
+# CLEAR Dataset
+# >> Elementary Sounds Analysis Cache
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+import os
+import json
+import hashlib
+
+
+def get_file_hash(filepath):
+    sha1 = hashlib.sha1()
+
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+class Sound_Analysis_Cache:
+    """
+    On-disk cache of the raw analysis values of the elementary sounds (duration, loudness, brightness)
+      - Entries are keyed by the analysis version and the SHA-1 of the audio file content. Renaming or moving a sound
+        keep its entry valid while modifying its content invalidate it
+      - {analysis_version} must be bumped when the analysis code change. Entries of other versions are dropped
+        when the cache is saved
+    """
+
+    def __init__(self, cache_filepath, analysis_version):
+        self.cache_filepath = cache_filepath
+        self.analysis_version = analysis_version
+        self.entries = {}
+        self.modified = False
+
+        if os.path.isfile(cache_filepath):
+            try:
+                with open(cache_filepath, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print("Invalid analysis cache '%s'. Starting from an empty cache" % cache_filepath)
+
+    def _get_key(self, file_hash):
+        return '%d:%s' % (self.analysis_version, file_hash)
+
+    def get(self, file_hash):
+        return self.entries.get(self._get_key(file_hash))
+
+    def set(self, file_hash, values):
+        self.entries[self._get_key(file_hash)] = values
+        self.modified = True
+
+    def save(self):
+        if not self.modified:
+            return
+
+        key_prefix = '%d:' % self.analysis_version
+        entries = {key: value for key, value in self.entries.items() if key.startswith(key_prefix)}
+
+        # Write to a temporary file first so that an interrupted run doesn't leave a corrupted cache
+        tmp_filepath = self.cache_filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+
+        os.replace(tmp_filepath, self.cache_filepath)
+        self.modified = False
@@ -0,0 +1,187 @@
+# CLEAR Dataset
+# >> Packed Elementary Sounds Bank
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+import json
+import struct
+import numpy as np
+
+from utils.misc import pydub_audiosegment_to_float_array, float_array_to_int_samples
+
+"""
+    Packed sound bank file layout
+        - Magic bytes         : b'CLEARSB1'
+        - Header size         : Little endian uint64
+        - Header              : UTF-8 JSON
+                                  - sample_format, dtype, sample_width, native_frame_rate
+                                  - variants : {frame_rate: {'data_offset', 'nb_samples'}} (Offset from the samples start)
+                                  - sounds   : [{'filename', 'attributes', 'offsets': {frame_rate: [start, length]}}]
+                                               The sounds are retrieved by filename. The attributes don't contain the
+                                               'id' of the sounds, it depends on the order of the definition
+        - Samples             : One contiguous mono sample array per frame rate, aligned on {data_alignment} bytes.
+                                Sounds are concatenated, their position in the array is given by 'offsets'
+
+    The sample arrays are memory mapped. The pages are shared by all the process reading the bank
+"""
+
+SOUND_BANK_MAGIC = b'CLEARSB1'
+data_alignment = 64
+
+sample_formats = ['native', 'int16', 'float32']
+
+
+def _align(nb_bytes):
+    return -(-nb_bytes // data_alignment) * data_alignment
+
+
+def _get_data_start(header_size):
+    return _align(len(SOUND_BANK_MAGIC) + 8 + header_size)
+
+
+def _get_dtype(sample_format, sample_width):
+    if sample_format == 'float32':
+        return np.dtype('<f4')
+
+    return np.dtype('<i%d' % sample_width)
+
+
+def _to_samples(audio_segment, sample_format, dtype):
+    if sample_format == 'float32':
+        return pydub_audiosegment_to_float_array(audio_segment, audio_segment.frame_rate,
+                                                 audio_segment.sample_width).astype(dtype)
+
+    return np.frombuffer(audio_segment.raw_data, dtype=dtype)
+
+
+def write_sound_bank(filepath, sounds, frame_rates, sample_format='native'):
+    """
+    Write the sounds in a packed sound bank
+    {sounds} is a list of (definition, audio_segment). The definition must contain the 'filename' of the sound
+    A variant of each sound is resampled (pydub set_frame_rate) and stored for each of the {frame_rates}
+    """
+    assert sample_format in sample_formats, "Unknown sample format '%s'" % sample_format
+
+    native_frame_rates = set(audio_segment.frame_rate for _, audio_segment in sounds)
+    sample_width = max(audio_segment.sample_width for _, audio_segment in sounds)
+
+    if sample_format == 'int16':
+        sample_width = 2
+
+    dtype = _get_dtype(sample_format, sample_width)
+
+    header = {
+        'sample_format': sample_format,
+        'dtype': dtype.str,
+        'sample_width': sample_width,
+        'native_frame_rate': native_frame_rates.pop() if len(native_frame_rates) == 1 else None,
+        'variants': {},
+        'sounds': [{
+            'filename': definition['filename'],
+            'attributes': {key: value for key, value in definition.items() if key != 'id'},
+            'offsets': {}
+        } for definition, _ in sounds]
+    }
+
+    variants_samples = []
+    for frame_rate in frame_rates:
+        samples = []
+        nb_samples = 0
+        for sound_header, (_, audio_segment) in zip(header['sounds'], sounds):
+            audio_segment = audio_segment.set_channels(1).set_sample_width(sample_width)
+
+            if audio_segment.frame_rate != frame_rate:
+                audio_segment = audio_segment.set_frame_rate(frame_rate)
+
+            sound_samples = _to_samples(audio_segment, sample_format, dtype)
+            sound_header['offsets'][str(frame_rate)] = [nb_samples, len(sound_samples)]
+            samples.append(sound_samples)
+            nb_samples += len(sound_samples)
+
+        variants_samples.append(np.concatenate(samples) if len(samples) > 0 else np.zeros(0, dtype=dtype))
+
+    # Offsets are relative to the start of the samples section
+    data_size = 0
+    for frame_rate, samples in zip(frame_rates, variants_samples):
+        header['variants'][str(frame_rate)] = {
+            'data_offset': data_size,
+            'nb_samples': len(samples)
+        }
+        data_size += _align(samples.nbytes)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _get_data_start(len(header_bytes))
+
+    with open(filepath, 'wb') as f:
+        f.write(SOUND_BANK_MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+
+        for samples, variant in zip(variants_samples, header['variants'].values()):
+            f.write(b'\0' * (data_start + variant['data_offset'] - f.tell()))
+            f.write(samples.tobytes())
+
+
+class Packed_Sound_Bank:
+    """
+    Read-only access to a packed sound bank written by write_sound_bank()
+    The samples are memory mapped, nothing is decoded or copied when the bank is opened
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+        with open(filepath, 'rb') as f:
+            magic = f.read(len(SOUND_BANK_MAGIC))
+            assert magic == SOUND_BANK_MAGIC, "'%s' is not a packed sound bank" % filepath
+
+            header_size, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_size).decode('utf-8'))
+
+        data_start = _get_data_start(header_size)
+
+        self.sample_format = header['sample_format']
+        self.sample_width = header['sample_width']
+        self.native_frame_rate = header['native_frame_rate']
+        self.dtype = np.dtype(header['dtype'])
+        self.sounds = header['sounds']
+        self.index_by_filename = {sound['filename']: index for index, sound in enumerate(self.sounds)}
+
+        self.variants = {}
+        for frame_rate, variant in header['variants'].items():
+            self.variants[int(frame_rate)] = np.memmap(filepath, dtype=self.dtype, mode='r',
+                                                       offset=data_start + variant['data_offset'],
+                                                       shape=(variant['nb_samples'],))
+
+    @property
+    def frame_rates(self):
+        return list(self.variants.keys())
+
+    def __len__(self):
+        return len(self.sounds)
+
+    def __contains__(self, filename):
+        return filename in self.index_by_filename
+
+    def get_samples(self, filename, frame_rate):
+        """
+        Return a read-only view on the samples of a sound
+        """
+        start, length = self.sounds[self.index_by_filename[filename]]['offsets'][str(frame_rate)]
+
+        return self.variants[frame_rate][start:start + length]
+
+    def get_pcm_samples(self, filename, frame_rate):
+        """
+        Return the integer samples (Of {self.sample_width} bytes) of a sound. Float samples are converted
+        """
+        samples = self.get_samples(filename, frame_rate)
+
+        if self.sample_format == 'float32':
+            return float_array_to_int_samples(samples, self.sample_width)
+
+        return samples
@@ -0,0 +1,103 @@
+# CLEAR Dataset
+# >> Spectrogram Computation & PNG Writing
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+import zlib
+import struct
+
+import numpy as np
+
+"""
+    NumPy spectrogram (Same values as matplotlib specgram with a hanning window and scale='dB')
+      - The frames are strided views on the samples, windowed by a Hann window and transformed with rfft
+      - The power spectral density is converted to dB and normalized between its min and max
+      - The normalized values are mapped through a colormap lookup table and resampled (Nearest neighbour) to the
+        pixel grid. Low frequencies are at the bottom of the image
+      - The image is written as a RGBA PNG without going through a matplotlib figure
+"""
+
+spectrogram_backends = ['matplotlib', 'numpy']
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+
+def compute_spectrogram(samples, frame_rate, window_length, window_overlap):
+    """
+    Power spectral density in dB of each frame. Shape : (window_length // 2 + 1 frequencies, nb_frames)
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    step = window_length - window_overlap
+
+    if len(samples) < window_length:
+        samples = np.concatenate([samples, np.zeros(window_length - len(samples))])
+
+    nb_frames = (len(samples) - window_overlap) // step
+    frames = np.lib.stride_tricks.as_strided(samples, shape=(nb_frames, window_length),
+                                             strides=(samples.strides[0] * step, samples.strides[0]),
+                                             writeable=False)
+
+    window = np.hanning(window_length)
+    spectrum = np.fft.rfft(frames * window, axis=1)
+
+    # One sided power spectral density (Scaled by the frequency like matplotlib)
+    psd = np.abs(spectrum) ** 2 / (frame_rate * (window ** 2).sum())
+    psd[:, 1:-1 if window_length % 2 == 0 else None] *= 2
+
+    return 10 * np.log10(psd.T)
+
+
+def get_colormap_lut(colormap_name, nb_colors=256):
+    """
+    RGBA uint8 lookup table of a matplotlib colormap
+    """
+    # Only import matplotlib for the colormap definition
+    import matplotlib.pyplot as plt
+
+    colormap = plt.get_cmap(colormap_name, nb_colors)
+
+    return (colormap(np.arange(nb_colors)) * 255 + 0.5).astype(np.uint8)
+
+
+def spectrogram_to_image(spectrogram_db, width, height, colormap_lut):
+    """
+    Map the spectrogram values through {colormap_lut} and resample it to {width} x {height} pixels
+    """
+    finite_values = spectrogram_db[np.isfinite(spectrogram_db)]
+    vmin, vmax = (finite_values.min(), finite_values.max()) if len(finite_values) > 0 else (0, 1)
+
+    normalized = (spectrogram_db - vmin) / max(vmax - vmin, 1e-12)
+    normalized[np.isneginf(spectrogram_db)] = 0
+    color_indexes = np.clip((normalized * len(colormap_lut)).astype(np.int64), 0, len(colormap_lut) - 1)
+
+    nb_freqs, nb_frames = spectrogram_db.shape
+    rows = ((np.arange(height) + 0.5) * nb_freqs / height).astype(np.int64)[::-1]
+    columns = ((np.arange(width) + 0.5) * nb_frames / width).astype(np.int64)
+
+    return colormap_lut[color_indexes[rows[:, None], columns[None, :]]]
+
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+           struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+
+def write_png(filepath, rgba_image, compression_level=6):
+    """
+    Write a (height, width, 4) uint8 image as a 8 bits RGBA PNG
+    """
+    height, width, _ = rgba_image.shape
+
+    # Each row start with its filter type (0 : None)
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgba_image.reshape(height, width * 4)
+
+    with open(filepath, 'wb') as f:
+        f.write(png_signature)
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(_png_chunk(b'IDAT', zlib.compress(rows.tobytes(), compression_level)))
+        f.write(_png_chunk(b'IEND', b''))
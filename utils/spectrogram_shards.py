@@ -0,0 +1,161 @@
+# CLEAR Dataset
+# >> Spectrogram Tensor Shards
+#
+# Author :      Jerome Abdelnour
+# Year :        2018-2019
+# Affiliations: Universite de Sherbrooke - Electrical and Computer Engineering faculty
+#               KTH Stockholm Royal Institute of Technology
+#               IGLU - CHIST-ERA
+
+import os
+import json
+from glob import glob, escape as glob_escape
+
+import numpy as np
+
+"""
+    Spectrogram tensor shards layout ({version}/preprocessed/{set_type}/)
+        - {prefix}_{set_type}_spectrograms_{shard_index}.bin   : Raw array of the spectrograms of the scenes
+                                                                 [shard_index * scenes_per_shard, next shard[
+                                                                 Each spectrogram is stored as (nb_frames, nb_freqs)
+                                                                 and the spectrograms are concatenated along the frames
+        - {prefix}_{set_type}_spectrograms_{shard_index}.json  : Index of the shard
+                                                                 dtype, nb_freqs, nb_frames (Total) and for each scene
+                                                                 its frame offset and its number of frames
+    The shards can be memory mapped, a spectrogram is a view on the shard (No decoding)
+    The shard of a scene only depend on its index so that different runs (Ex : --produce_specific_scenes on different
+    machines) write different shards as long as the ranges are aligned on {scenes_per_shard}
+"""
+
+spectrogram_tensor_dtypes = ['float16', 'float32']
+
+
+def get_shard_filepath(folder, prefix, set_type, shard_index, extension):
+    return os.path.join(folder, '%s_%s_spectrograms_%05d.%s' % (prefix, set_type, shard_index, extension))
+
+
+class Spectrogram_Shard_Writer:
+    """
+    Write the spectrograms in shards of {scenes_per_shard} scenes
+    The spectrograms can be added in any order, they are buffered and written in scene order.
+    Scenes that won't be produced (Failures) must be skipped for the following scenes to be written
+    """
+
+    def __init__(self, folder, prefix, set_type, scene_ids, scenes_per_shard=1000, dtype='float16', info=None):
+        self.folder = folder
+        self.prefix = prefix
+        self.set_type = set_type
+        self.scene_ids = iter(scene_ids)
+        self.scenes_per_shard = scenes_per_shard
+        self.dtype = np.dtype(dtype)
+        self.info = info if info is not None else {}
+
+        self.next_scene_id = next(self.scene_ids, None)
+        self.buffered = {}
+
+        self.shard_index = None
+        self.shard_file = None
+        self.shard_index_data = None
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def add(self, scene_id, spectrogram):
+        """
+        {spectrogram} is a (nb_freqs, nb_frames) array or None if the scene was not produced
+        """
+        self.buffered[scene_id] = spectrogram
+
+        while self.next_scene_id is not None and self.next_scene_id in self.buffered:
+            spectrogram = self.buffered.pop(self.next_scene_id)
+            if spectrogram is not None:
+                self._write(self.next_scene_id, spectrogram)
+
+            self.next_scene_id = next(self.scene_ids, None)
+
+    def _write(self, scene_id, spectrogram):
+        shard_index = scene_id // self.scenes_per_shard
+        if shard_index != self.shard_index:
+            self._close_shard()
+            self._open_shard(shard_index)
+
+        frames = np.ascontiguousarray(spectrogram.T, dtype=self.dtype)
+
+        if self.shard_index_data['nb_freqs'] is None:
+            self.shard_index_data['nb_freqs'] = frames.shape[1]
+
+        assert frames.shape[1] == self.shard_index_data['nb_freqs'], \
+            "All the spectrograms must have the same number of frequencies"
+
+        self.shard_index_data['scenes'][str(scene_id)] = [self.shard_index_data['nb_frames'], frames.shape[0]]
+        self.shard_index_data['nb_frames'] += frames.shape[0]
+        self.shard_file.write(frames.tobytes())
+
+    def _open_shard(self, shard_index):
+        self.shard_index = shard_index
+        self.shard_file = open(get_shard_filepath(self.folder, self.prefix, self.set_type, shard_index, 'bin'), 'wb')
+        self.shard_index_data = {
+            'info': self.info,
+            'dtype': self.dtype.str,
+            'nb_freqs': None,
+            'nb_frames': 0,
+            'scenes': {}
+        }
+
+    def _close_shard(self):
+        if self.shard_file is None:
+            return
+
+        self.shard_file.close()
+        with open(get_shard_filepath(self.folder, self.prefix, self.set_type, self.shard_index, 'json'), 'w') as f:
+            json.dump(self.shard_index_data, f, indent=2)
+
+        self.shard_file = None
+
+    def close(self):
+        assert len(self.buffered) == 0, "Some spectrograms were not written. Missing scene %s" % self.next_scene_id
+
+        self._close_shard()
+
+
+class Spectrogram_Tensors:
+    """
+    Read-only access to the spectrograms of a set written by Spectrogram_Shard_Writer
+    The shards are memory mapped. Indexed by scene index, return a (nb_freqs, nb_frames) view
+    """
+
+    def __init__(self, folder, prefix, set_type):
+        self.shards = []
+        self.scene_locations = {}
+
+        pattern = glob_escape(os.path.join(folder, '%s_%s_spectrograms_' % (prefix, set_type))) + '[0-9]*.json'
+        for shard_index_filepath in sorted(glob(pattern)):
+            with open(shard_index_filepath, 'r') as f:
+                shard_index_data = json.load(f)
+
+            if shard_index_data['nb_frames'] == 0:
+                continue
+
+            shard = np.memmap(os.path.splitext(shard_index_filepath)[0] + '.bin', mode='r',
+                              dtype=np.dtype(shard_index_data['dtype']),
+                              shape=(shard_index_data['nb_frames'], shard_index_data['nb_freqs']))
+
+            for scene_id, (offset, nb_frames) in shard_index_data['scenes'].items():
+                self.scene_locations[int(scene_id)] = (len(self.shards), offset, nb_frames)
+
+            self.shards.append(shard)
+
+    @property
+    def scene_ids(self):
+        return sorted(self.scene_locations.keys())
+
+    def __len__(self):
+        return len(self.scene_locations)
+
+    def __contains__(self, scene_id):
+        return scene_id in self.scene_locations
+
+    def __getitem__(self, scene_id):
+        shard_index, offset, nb_frames = self.scene_locations[scene_id]
+
+        return self.shards[shard_index][offset:offset + nb_frames].T